@@ -10,12 +10,50 @@ This program is free software under the GNU General Public License v3.0
 import datetime
 import os
 import logging
-from flask import Flask, request, make_response, Response
+from flask import Flask, request, make_response, Response, stream_with_context, copy_current_request_context, has_request_context, jsonify, abort
+from werkzeug.exceptions import HTTPException
 import colorama
 import sys
 import subprocess
 import html
 import ast
+import re
+import threading
+import time
+import types
+import functools
+import fnmatch
+import hashlib
+import pickle
+import asyncio
+import inspect
+import io
+import queue
+import multiprocessing
+import contextvars
+import marshal
+import importlib.util
+import socket
+import struct
+import tempfile
+import atexit
+import heapq
+import itertools
+import email.utils
+import gzip
+import ctypes
+import ctypes.util
+from collections import OrderedDict
+
+try:
+    import brotli  # Optional: Brotli compression of static files
+except ImportError:
+    brotli = None
+
+try:
+    import psutil  # Optional: memory of render workers where /proc is not available
+except ImportError:
+    psutil = None
 
 # Initialize colorama for colored console output
 colorama.init()
@@ -39,6 +77,60 @@ class Config:
     # Large file download settings
     LARGE_FILE_THRESHOLD = 50 * 1024 * 1024  # 50MB threshold for streaming
     CHUNK_SIZE = 64 * 1024  # 64KB chunks for streaming
+    MAX_RANGES = 16  # Max byte ranges in one request, more are answered with the whole file
+    SENDFILE = True  # Hand large files to the WSGI server's wsgi.file_wrapper (zero-copy sendfile) when it has one
+    STATIC_CACHE_SIZE = 64 * 1024 * 1024  # Byte budget of the in-memory cache of small static files (0 disables)
+    STATIC_CACHE_MAX_FILE_SIZE = 1024 * 1024  # Larger files are always read from disk
+    STATIC_CACHE_REVALIDATE = 1  # Seconds a cached file is trusted before its mtime/size is checked again (0 checks every request)
+    ETAG = 'strong'  # ETags of static files: 'strong'/'weak' from inode/size/mtime, 'hash' from the content, None disables
+    ETAG_HASH_CACHE_SIZE = 4096  # Max number of content hashes kept for ETAG = 'hash'
+    COMPRESS = True  # Compress text files below LARGE_FILE_THRESHOLD on the fly for clients that accept gzip/br
+    PRECOMPRESSED = True  # Serve .br/.gz files next to a static file (written by --precompress) when they are up to date
+    COMPRESS_TYPES = ['text/*', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml']
+    COMPRESS_MIN_SIZE = 1024  # Smaller files are sent uncompressed
+    COMPRESS_MAX_SIZE = 8 * 1024 * 1024  # Larger files are only sent compressed from precompressed siblings
+    COMPRESS_LEVEL = 6  # gzip level for on-the-fly compression (1-9)
+    BROTLI_QUALITY = 5  # Brotli quality for on-the-fly compression (0-11), needs the brotli package
+    COMPRESS_CACHE_SIZE = 32 * 1024 * 1024  # Byte budget of the cache of compressed files
+    CACHE_CONTROL = {}  # {category or path glob: Cache-Control} of static files, categories: html, image, video, audio, font, download, other
+    CACHE_CONTROL_HOSTS = {}  # {host: rules like CACHE_CONTROL}, take precedence for requests to that host
+    CACHE_FINGERPRINT_PATTERN = r'\.[0-9a-f]{8,}\.\w+$'  # File names with a content hash, e.g. app.3f9c2b1a.js (None disables)
+    CACHE_CONTROL_FINGERPRINTED = 'public, max-age=31536000, immutable'  # Cache-Control of fingerprinted files
+    CACHE_EXPIRES = True  # Also send Expires, computed from the max-age of the Cache-Control policy
+
+    # Cache of what serve() finds at a path (index file, directory, file or nothing)
+    PATH_CACHE_SIZE = 10000  # Max number of cached path resolutions, including misses (0 disables)
+    PATH_CACHE_TTL = 60  # Seconds a resolution is kept at most
+    PATH_CACHE_WATCH = True  # Drop resolutions when their directory changes (inotify on Linux, else polling)
+    PATH_CACHE_POLL_INTERVAL = 2  # Seconds between directory mtime checks where inotify is unavailable (None disables)
+
+    # .pys template cache (parsed segments and compiled <python> blocks)
+    TEMPLATE_CACHE_SIZE = 256  # Max number of cached .pys files (0 disables)
+    BYTECODE_CACHE_DIR = './cache/pys'  # Where --precompile writes compiled .pys pages (None disables)
+    FUNCTION_RELOAD_INTERVAL = 2  # Seconds between function.py change checks (None disables)
+    PYS_STREAMING = False  # Send .pys output to the client as each segment is rendered
+    PYS_NO_STREAM_MARKER = '<!-- pyserve:no-stream -->'  # Pages containing this marker are never streamed
+    PYS_MAX_OUTPUT_SIZE = None  # Max characters a .pys page may output (None for unlimited)
+    INCLUDE_MAX_DEPTH = 8  # Max nesting depth of include() in .pys pages
+    FRAGMENT_CACHE_SIZE = 16 * 1024 * 1024  # Byte budget of the cache() fragment cache
+
+    # Full-response cache for dynamic pages (.pys, .php, .pp)
+    RESPONSE_CACHE_RULES = {}  # {path glob: ttl seconds}, e.g. {'/': 60, '/news/*': 300}
+    RESPONSE_CACHE_VARY = []  # Request headers that are part of the cache key, e.g. ['Accept-Language']
+    RESPONSE_CACHE_STALE = 0  # Seconds an expired page may still be served while it is re-rendered
+    RESPONSE_CACHE_SIZE = 64 * 1024 * 1024  # Byte budget of the in-memory response cache
+    RESPONSE_CACHE_DIR = None  # Directory of the optional disk tier (None disables)
+
+    # Per-block timing of dynamic pages
+    SERVER_TIMING = False  # Add a Server-Timing header with per-block timings to non-streamed pages
+    ADMIN_PATH = None  # URL of the statistics page, e.g. '/_pyserve/stats' (None disables)
+    ADMIN_ALLOWED_IPS = ['127.0.0.1', '::1']  # Clients allowed to view the statistics page
+
+    # Pre-forked worker processes for .pys rendering
+    PYS_WORKER_PROCESSES = 0  # Number of render worker processes (0 renders in the server thread)
+    PYS_WORKER_TIMEOUT = 30  # Seconds a page may run in a worker before the worker is killed
+    PYS_WORKER_MAX_RENDERS = 1000  # Recycle a worker after this many pages (None disables)
+    PYS_WORKER_MAX_RSS = 512 * 1024 * 1024  # Recycle a worker once its RSS exceeds this many bytes (Linux, or psutil installed; None disables)
 
     # File type categories
     HTML_EXTENSIONS = ['html', 'htm', 'pys', 'php', 'pp']
@@ -117,15 +209,40 @@ class Config:
                                're', 'collections', 'subprocess', 'socket', 'urllib',
                                'csv', 'pickle', 'sqlite3', 'hashlib', 'itertools', 'logging',
                                'secret', 'base64', 'email', 'functools', 'glob', 'html',
-                               'string', 'shutil', 'smtplib']
+                               'string', 'shutil', 'smtplib', 'asyncio']
 
     #PHP related content
     PHP_CGI_PATH = "./PHP/php-cgi"
-
+    PHP_TIMEOUT = 10
+    PHP_MAX_EXECUTION_TIME = 10
+    PHP_STREAMING = False
+    PHP_MAX_BODY_SIZE = None
+    PHP_MAX_CONCURRENCY = None
+    PHP_QUEUE_SIZE = 100
+    PHP_QUEUE_TIMEOUT = 5
+    PHP_RETRY_AFTER = 5
+    PHP_PRIORITIES = {}
+    PP_CACHE_PHP_OUTPUT = False
+    PHP_ENV_ALLOWLIST = ['PATH', 'SYSTEMROOT', 'WINDIR', 'COMSPEC', 'TEMP', 'TMP', 'TMPDIR',
+                         'LANG', 'LC_ALL', 'TZ', 'PHPRC', 'PHP_INI_SCAN_DIR']
+    PHP_FASTCGI = False
+    PHP_FASTCGI_WORKERS = 4
+    PHP_FASTCGI_MAX_REQUESTS = 500
+    PHP_FASTCGI_TIMEOUT = 10
+    PHP_FASTCGI_HEALTH_INTERVAL = 10
+    PHP_FASTCGI_SOCKET_DIR = None
+    PHP_FASTCGI_PORT = 9100
+    PHP_FASTCGI_ADDRESS = None
+
+
+# Command line: PyServe.py [--precompile] [--precompress] [config_dir]
+PRECOMPILE = '--precompile' in sys.argv[1:]
+PRECOMPRESS = '--precompress' in sys.argv[1:]
+cli_args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
 
 # Try to load custom configuration
-if len(sys.argv) > 1:
-    Config.CONFIG_DIR = sys.argv[1]
+if cli_args:
+    Config.CONFIG_DIR = cli_args[0]
 try:
     config_path = os.path.join(Config.CONFIG_DIR, 'config.cfg')
     if os.path.exists(config_path):
@@ -137,10 +254,11 @@ try:
 except Exception as e:
     print(colorama.Fore.RED + f'Error loading config: {str(e)}\nUsing default configuration')
 
+function_config = ''
+function_path = os.path.join(Config.CONFIG_DIR, 'function.py')
 try:
-    config_path = os.path.join(Config.CONFIG_DIR, 'function.py')
-    if os.path.exists(config_path):
-        with open(config_path, 'r', encoding='utf-8') as config_file:
+    if os.path.exists(function_path):
+        with open(function_path, 'r', encoding='utf-8') as config_file:
             function_config = config_file.read()
         print(colorama.Fore.GREEN + 'Function loaded successfully')
     else:
@@ -164,47 +282,58 @@ print(colorama.Fore.RESET)
 # Python Interpreter
 # ================
 
+_TAG_CANDIDATE = re.compile(r'<(?:!\[CDATA\[|!--|script|style|python>|/python>)', re.IGNORECASE | re.ASCII)
+_COMMENT_EVENT = re.compile(r'-->|<!\[CDATA\[')
+_TAG_END_EVENT = re.compile(r'[>"\']')
+_STRING_END = {q: re.compile(r'[\\' + q + ']') for q in ('"', "'", '`')}
+_RAW_TEXT_EVENT = {
+    tag: re.compile(re.escape(tag) + r'|["\'`]', re.IGNORECASE | re.ASCII)
+    for tag in ('</script>', '</style>')
+}
+_TAG_DELIMITERS = ' \t\n\r>/'
+
+
 def extract_python_tags(html_content):
     """
     从HTML中提取内容，返回 [("html", ...), ("python", ...), ...] 格式的列表
     """
     def _find_tag_end(html_content, start):
         i = start
-        length = len(html_content)
-        while i < length:
+        while True:
+            m = _TAG_END_EVENT.search(html_content, i)
+            if m is None:
+                return -1
+            i = m.start()
             c = html_content[i]
             if c == '>':
                 return i
-            elif c in ('"', "'"):
-                quote = c
-                i += 1
-                while i < length:
-                    ch = html_content[i]
-                    if ch == quote:
-                        break
-                    i += 1
+            i = html_content.find(c, i + 1)
+            if i == -1:
+                return -1
             i += 1
-        return -1
     def _find_raw_text_end(html_content, i, end_tag):
         length = len(html_content)
-        end_tag_len = len(end_tag)
-        in_string = False
-        string_char = None
+        event = _RAW_TEXT_EVENT[end_tag]
         while i < length:
-            c = html_content[i]
-            if in_string:
-                if c == '\\':
+            m = event.search(html_content, i)
+            if m is None:
+                return -1
+            i = m.start()
+            string_char = html_content[i]
+            if string_char == '<':
+                return i
+            string_end = _STRING_END[string_char]
+            i += 1
+            while True:
+                m = string_end.search(html_content, i)
+                if m is None:
+                    return -1
+                i = m.start()
+                if html_content[i] == '\\':
                     i += 2
                     continue
-                if c == string_char:
-                    in_string = False
-            else:
-                if html_content[i:i + end_tag_len].lower() == end_tag:
-                    return i
-                if c in ('"', "'", '`'):
-                    in_string = True
-                    string_char = c
-            i += 1
+                i += 1
+                break
         return -1
     results = []
     i = 0
@@ -226,64 +355,66 @@ def extract_python_tags(html_content):
         html_start = end
     while i < length:
         if in_cdata:
-            if html_content[i:i + 3] == ']]>':
-                in_cdata = False
-                i += 3
-            else:
-                i += 1
-            continue
-        if html_content[i:i + 9] == '<![CDATA[':
-            in_cdata = True
-            i += 9
-            continue
-        if in_script:
-            end_pos = _find_raw_text_end(html_content, i, '</script>')
+            end_pos = html_content.find(']]>', i)
             if end_pos == -1:
                 break
-            in_script = False
-            i = end_pos + 9
+            in_cdata = False
+            i = end_pos + 3
             continue
-        if in_style:
-            end_pos = _find_raw_text_end(html_content, i, '</style>')
+        if in_script or in_style or in_comment:
+            # CDATA is recognised at the current position before anything else
+            if html_content.startswith('<![CDATA[', i):
+                in_cdata = True
+                i += 9
+                continue
+            if in_comment:
+                m = _COMMENT_EVENT.search(html_content, i)
+                if m is None:
+                    break
+                i = m.start()
+                if html_content[i] == '-':
+                    in_comment = False
+                    i += 3
+                else:
+                    in_cdata = True
+                    i += 9
+                continue
+            end_tag = '</script>' if in_script else '</style>'
+            end_pos = _find_raw_text_end(html_content, i, end_tag)
             if end_pos == -1:
                 break
-            in_style = False
-            i = end_pos + 8
+            in_script = in_style = False
+            i = end_pos + len(end_tag)
+            continue
+        m = _TAG_CANDIDATE.search(html_content, i)
+        if m is None:
+            break
+        i = m.start()
+        if html_content.startswith('<![CDATA[', i):
+            in_cdata = True
+            i += 9
             continue
-        if not in_comment and html_content[i:i + 4] == '<!--':
+        if html_content.startswith('<!--', i):
             in_comment = True
             i += 4
             continue
-        if in_comment and html_content[i:i + 3] == '-->':
-            in_comment = False
-            i += 3
-            continue
-        if in_comment:
-            i += 1
-            continue
-        if not in_script and not in_python_tag and i + 7 <= length:
-            tag_check = html_content[i:i + 7].lower()
-            if tag_check == '<script' and (
-                i + 7 >= length or html_content[i + 7] in ' \t\n\r>/'):
-                close = _find_tag_end(html_content, i + 7)
-                if close != -1:
-                    in_script = True
-                    i = close + 1
-                else:
-                    i += 1
-                continue
-        if not in_style and not in_python_tag and i + 6 <= length:
-            tag_check = html_content[i:i + 6].lower()
-            if tag_check == '<style' and (
-                i + 6 >= length or html_content[i + 6] in ' \t\n\r>/'):
-                close = _find_tag_end(html_content, i + 6)
+        if not in_python_tag:
+            if html_content[i:i + 7].lower() == '<script':
+                tag_end = i + 7
+            elif html_content[i:i + 6].lower() == '<style':
+                tag_end = i + 6
+            else:
+                tag_end = -1
+            if tag_end != -1 and (tag_end >= length or html_content[tag_end] in _TAG_DELIMITERS):
+                close = _find_tag_end(html_content, tag_end)
                 if close != -1:
-                    in_style = True
+                    in_script = tag_end == i + 7
+                    in_style = not in_script
                     i = close + 1
                 else:
                     i += 1
                 continue
-        if i + 8 <= length and html_content[i:i + 8].lower() == '<python>':
+        if html_content[i:i + 8].lower() == '<python>':
             if not in_python_tag:
                 flush_html(i)
                 html_start = i + 8
@@ -294,17 +425,16 @@ def extract_python_tags(html_content):
                 python_depth += 1
             i += 8
             continue
-        if in_python_tag and i + 9 <= length:
-            if html_content[i:i + 9].lower() == '</python>':
-                python_depth -= 1
-                if python_depth == 0:
-                    content = html_content[python_start:i]
-                    results.append(("python", content))
-                    in_python_tag = False
-                    python_start = -1
-                    html_start = i + 9
-                i += 9
-                continue
+        if in_python_tag and html_content[i:i + 9].lower() == '</python>':
+            python_depth -= 1
+            if python_depth == 0:
+                content = html_content[python_start:i]
+                results.append(("python", content))
+                in_python_tag = False
+                python_start = -1
+                html_start = i + 9
+            i += 9
+            continue
         i += 1
     if in_python_tag:
         results.append(("python", f'echo("<span class="python-warning">Unclosed <python> tag detected (depth={python_depth}), content discarded.</span>")'))
@@ -312,144 +442,1269 @@ def extract_python_tags(html_content):
         flush_html(length)
     return results
 
-def run_python(text, exec_scope=None):
+_OUTPUT_SLOT = object()
+_OUTPUT_FUNCTIONS = ('print', 'echo', 'cache', 'include')
+_base_namespace = None
+_base_namespace_lock = threading.Lock()
+
+
+def _disabled_function(*args, **kwargs):
+    raise NameError('This function has been disabled')
+
+
+def build_base_namespace(source):
+    """
+    Build the base scope shared by all <python> blocks: helpers from
+    function.py, disabled function stubs and whitelisted libraries.
+    Returns (namespace, output_slots) where output_slots lists the names
+    that must be bound to the per-block print/echo/cache/include functions.
+    """
+    namespace = {'__builtins__': __builtins__}
+    for name in _OUTPUT_FUNCTIONS:
+        namespace[name] = _OUTPUT_SLOT
+    helpers = {}
+    if source:
+        try:
+            helper_globals = dict(globals())
+            exec(compile(source, function_path, 'exec'), helper_globals)
+            tree = ast.parse(source)
+            for node in ast.walk(tree):
+                if isinstance(node, ast.FunctionDef) and node.name in helper_globals:
+                    helpers[node.name] = helper_globals[node.name]
+        except Exception:
+            print(colorama.Fore.RED + 'Function execution failed')
+    for name, func in helpers.items():
+        if name not in Config.DISABLE_PYTHON_FUNCTIONS:
+            namespace[name] = func
+    for name in Config.DISABLE_PYTHON_FUNCTIONS:
+        namespace[name] = _disabled_function
+    for name in Config.ENABLE_PYTHON_LIBRARIES:
+        try:
+            namespace[name] = __import__(name)
+        except:
+            continue
+    output_slots = tuple(name for name in _OUTPUT_FUNCTIONS if namespace[name] is _OUTPUT_SLOT)
+    return types.MappingProxyType(namespace), output_slots
+
+
+def _function_identity():
     try:
-        content = ''
-        if exec_scope is None:
-            exec_scope = {'__builtins__': __builtins__}
-        elif '__builtins__' not in exec_scope:
-            exec_scope['__builtins__'] = __builtins__
+        st = os.stat(function_path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+def reload_function_config():
+    """Re-read function.py and rebuild the base namespace"""
+    global function_config, _base_namespace
+    identity = _function_identity()
+    source = ''
+    if identity is not None:
+        try:
+            with open(function_path, 'r', encoding='utf-8') as f:
+                source = f.read()
+        except Exception as e:
+            print(colorama.Fore.RED + f'Error loading Function: {str(e)}')
+            source = function_config
+    function_config = source
+    namespace, output_slots = build_base_namespace(source)
+    _base_namespace = (namespace, output_slots, identity, time.monotonic())
+    return namespace, output_slots
+
+
+def get_base_namespace():
+    """
+    Return the prebuilt (namespace, output_slots) pair.
+    function.py is checked for changes at most every FUNCTION_RELOAD_INTERVAL seconds.
+    """
+    global _base_namespace
+    current = _base_namespace
+    if current is not None:
+        interval = Config.FUNCTION_RELOAD_INTERVAL
+        if interval is None or time.monotonic() - current[3] < interval:
+            return current[0], current[1]
+    with _base_namespace_lock:
+        current = _base_namespace
+        if current is None:
+            return reload_function_config()
+        if _function_identity() != current[2]:
+            print(colorama.Fore.GREEN + 'Function file changed, reloading' + colorama.Fore.RESET)
+            return reload_function_config()
+        _base_namespace = current[:3] + (time.monotonic(),)
+        return current[0], current[1]
+
+
+class OutputLimitError(Exception):
+    """Raised when a page writes more than Config.PYS_MAX_OUTPUT_SIZE characters"""
+
+
+class OutputBuffer:
+    """
+    Output of a .pys page, shared by all of its blocks.
+    Text is kept as a list of chunks and only joined when flushed.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self.exceeded = False
+        self._chunks = []
+
+    def write(self, text):
+        if not text:
+            return
+        if self.max_size is not None and self.size + len(text) > self.max_size:
+            self.exceeded = True
+            raise OutputLimitError(f'Output limit of {self.max_size} characters exceeded')
+        self._chunks.append(text)
+        self.size += len(text)
+
+    def write_error(self, message):
+        """Write an error span, bypassing the size limit"""
+        self._chunks.append(f'<span class="python-error">{html.escape(str(message))}</span>')
+
+    def reserve(self, size):
+        """Count size characters written to the page around the buffer against the limit"""
+        if self.max_size is not None and self.size + size > self.max_size:
+            self.exceeded = True
+            raise OutputLimitError(f'Output limit of {self.max_size} characters exceeded')
+        self.size += size
+
+    def mark(self):
+        return len(self._chunks), self.size
+
+    def since(self, mark):
+        """Return the text written since mark (must not have been flushed since)"""
+        return "".join(self._chunks[mark[0]:])
+
+    def rollback(self, mark):
+        """Discard everything written since mark (must not have been flushed since)"""
+        del self._chunks[mark[0]:]
+        self.size = mark[1]
+
+    def flush(self):
+        """Remove and return all buffered text"""
+        text = "".join(self._chunks)
+        self._chunks.clear()
+        return text
+
+
+def new_output_buffer():
+    return OutputBuffer(Config.PYS_MAX_OUTPUT_SIZE)
+
+
+class FragmentCache:
+    """Process-wide LRU of rendered page fragments with a byte budget and TTL expiry"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires, size, text, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (text, value) for a live entry or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2], entry[3]
+
+    def set(self, key, text, value=None, ttl=None):
+        size = len(text) if isinstance(text, bytes) else len(text.encode(Config.ENCODING, 'ignore'))
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (expires, size, text, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions
+        }
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key)[1]
+
+
+fragment_cache = FragmentCache(Config.FRAGMENT_CACHE_SIZE)
+
+
+class CachedFragment:
+    """
+    Region of page output memoized in the fragment cache.
+    Used as a context manager (the value is True on a cache hit) or as a decorator.
+    Keys are namespaced by the document root, so sites sharing a process never see each other's fragments.
+    """
 
+    def __init__(self, output_buffer, key, ttl=None):
+        self.output_buffer = output_buffer
+        root = os.path.abspath(current_document_root()) if has_request_context() else None
+        self.key = (root, key)
+        self.ttl = ttl
+        self._mark = None
+
+    def __enter__(self):
+        entry = fragment_cache.get(self.key)
+        if entry is not None:
+            self.output_buffer.write(entry[0])
+            return True
+        self._mark = self.output_buffer.mark()
+        return False
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self._mark is not None:
+            fragment_cache.set(self.key, self.output_buffer.since(self._mark), ttl=self.ttl)
+        self._mark = None
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (self.key, repr(args), repr(sorted(kwargs.items()))) if args or kwargs else self.key
+            entry = fragment_cache.get(key)
+            if entry is not None:
+                self.output_buffer.write(entry[0])
+                return entry[1]
+            mark = self.output_buffer.mark()
+            value = func(*args, **kwargs)
+            fragment_cache.set(key, self.output_buffer.since(mark), value, self.ttl)
+            return value
+        return wrapper
+
+
+_event_loops = threading.local()
+
+
+def get_event_loop():
+    """Return the event loop owned by the current worker thread, creating it on first use"""
+    loop = getattr(_event_loops, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        _event_loops.loop = loop
+    return loop
+
+
+def run_python(text, output_buffer, exec_scope=None, block=None):
+    """
+    Execute a <python> block, writing print/echo output to the page buffer.
+    On error the block output is replaced by an error message.
+    `block` is the position of the block in its page, used for timing statistics.
+    Returns the exec_scope to share with the next block.
+    """
+    mark = output_buffer.mark()
+    start = time.perf_counter()
+    error = None
+    try:
         def new_print(*args, sep=' ', end='\n', file=None, flush=False, output=False):
-            nonlocal content
             output_file = file if file is not None else sys.stdout
             text = sep.join(str(arg) for arg in args)
             if output:
                 output_file.write(text + end)
                 if flush:
                     output_file.flush()
-            content += text
+            output_buffer.write(text)
         def new_echo(text):
-            nonlocal content
-            content += str(text)
+            output_buffer.write(str(text))
+        def new_cache(key, ttl=None):
+            return CachedFragment(output_buffer, key, ttl)
+        def new_include(path, **variables):
+            include_template(output_buffer, path, variables)
 
-        def ERROR(*args, **kwargs):
-            raise NameError('This function has been disabled')
+        namespace, output_slots = get_base_namespace()
+        if exec_scope is None:
+            exec_scope = dict(namespace)
+        elif '__builtins__' not in exec_scope:
+            exec_scope['__builtins__'] = __builtins__
+        output_funcs = {'print': new_print, 'echo': new_echo, 'cache': new_cache, 'include': new_include}
+        for name in output_slots:
+            exec_scope[name] = output_funcs[name]
+
+        if isinstance(text, BaseException):
+            raise text.with_traceback(None)
+        if isinstance(text, str):
+            text = compile_python_block(text)
+            if isinstance(text, BaseException):
+                raise text.with_traceback(None)
+        result = eval(text, exec_scope)
+        if text.co_flags & inspect.CO_COROUTINE:
+            get_event_loop().run_until_complete(result)
+    except Exception as e:
+        error = f'{type(e).__name__}: {str(e)}'
+        output_buffer.rollback(mark)
+        output_buffer.write_error(e)
+    if block is not None:
+        page = text.co_filename if isinstance(text, types.CodeType) else getattr(text, 'filename', None)
+        record_timing({
+            'metric': 'block', 'page': page_label(page), 'block': block,
+            'dur': (time.perf_counter() - start) * 1000,
+            'output': max(output_buffer.size - mark[1], 0), 'error': error
+        })
+    return exec_scope  # 返回 exec_scope 供下一个块使用
+
+
+def compile_python_block(source, filename='<string>', first_line=1):
+    """
+    Compile the source of a <python> block, allowing top-level await.
+    Line numbers are shifted to match the position of the block in its file.
+    Returns the code object, or the SyntaxError raised while compiling.
+    """
+    try:
+        return compile('\n' * (first_line - 1) + source, filename, 'exec',
+                       flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+    except (SyntaxError, ValueError) as e:
+        e.block_source = (source, first_line)
+        return e
 
-        func_dict = {}
-        try:
-            exec(function_config)
-            tree = ast.parse(function_config)
-            func_names = [node.name for node in ast.walk(tree) if isinstance(node, ast.FunctionDef)]
-            func_dict = ""
-            for func in func_names:
-                func_dict += f'"{func}": {func}, '
-            func_dict = f"{{{func_dict[:-2]}}}"
-            func_dict = eval(func_dict)
-        except:
-            print(colorama.Fore.RED + 'Function execution failed')
-        new = {'print': new_print, 'echo': new_echo}
-        for func in func_dict:
-            new[func] = func_dict[func]
 
-        for i in new:
-            if i in Config.DISABLE_PYTHON_FUNCTIONS:
-                continue
-            exec_scope[i] = new[i]
-        for func in Config.DISABLE_PYTHON_FUNCTIONS:
-            exec_scope[func] = ERROR
-        for i in Config.ENABLE_PYTHON_LIBRARIES:
+def compile_template(html_content, filename='<string>'):
+    """
+    Parse a .pys document and compile all of its <python> blocks.
+    Returns [("html", text), ("python", code), ...]
+    """
+    start = time.perf_counter()
+    parsed = extract_python_tags(html_content)
+    parse_time = time.perf_counter() - start
+    segments = []
+    line = 1
+    for kind, text in parsed:
+        if kind == "python":
+            segments.append((kind, compile_python_block(text, filename, line)))
+        else:
+            segments.append((kind, text))
+        line += text.count('\n')
+    compile_time = time.perf_counter() - start - parse_time
+    page = page_label(filename)
+    record_timing({'metric': 'parse', 'page': page, 'dur': parse_time * 1000})
+    record_timing({'metric': 'compile', 'page': page, 'dur': compile_time * 1000})
+    return segments
+
+
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+
+
+def load_template(path, parse=True):
+    """
+    Return the compiled segments of a .pys file.
+    With parse=False the file is plain HTML and becomes a single html segment.
+    Results are kept in an LRU keyed by (path, mtime, size), so a file is only
+    parsed and compiled again after it changes on disk.
+    """
+    path = os.path.abspath(path)
+    key = (path, parse)
+    st = os.stat(path)
+    identity = (st.st_mtime_ns, st.st_size)
+    with _template_cache_lock:
+        entry = _template_cache.get(key)
+        if entry is not None and entry[0] == identity:
+            _template_cache.move_to_end(key)
+            return entry[1]
+
+    with open(path, 'r', encoding=Config.ENCODING) as f:
+        content = f.read()
+    segments = compile_template(content, path) if parse else [("html", content)]
+
+    if Config.TEMPLATE_CACHE_SIZE:
+        with _template_cache_lock:
+            _template_cache[key] = (identity, segments)
+            _template_cache.move_to_end(key)
+            while len(_template_cache) > Config.TEMPLATE_CACHE_SIZE:
+                _template_cache.popitem(last=False)
+    return segments
+
+
+def execute_segments(segments, output_buffer, exec_scope=None):
+    """Execute compiled template segments into output_buffer, yielding after each segment"""
+    block = 0
+    for kind, value in segments:
+        if kind == "html":
             try:
-                exec_scope[i] = __import__(i)
-            except:
-                continue
+                output_buffer.write(value)
+            except OutputLimitError as e:
+                output_buffer.write_error(e)
+        elif kind == "python":
+            block += 1
+            exec_scope = run_python(value, output_buffer, exec_scope, block)
+        yield
+        if output_buffer.exceeded:
+            break
+
+
+def iter_template(segments, output=None):
+    """
+    Execute compiled template segments into a shared output buffer.
+    The buffer is flushed after every segment and the text is yielded as soon as it is ready.
+    """
+    if output is None:
+        output = new_output_buffer()
+    for _ in execute_segments(segments, output):
+        text = output.flush()
+        if text:
+            yield text
 
-        exec(text, exec_scope)
-    except Exception as e:
-        error_msg = html.escape(str(e))
-        content = f'<span class="python-error">{error_msg}</span>'
-    return content, exec_scope  # 同时返回 exec_scope 供下一个块使用
+
+class IncludeError(Exception):
+    """Raised when include() cannot render a file"""
+
+
+_include_stack = contextvars.ContextVar('include_stack', default=())
+
+
+def current_document_root():
+    """Document root of the current request"""
+    return request.environ.get('pyserve.document_root', Config.WWW_ROOT)
+
+
+def include_template(output_buffer, path, variables):
+    """
+    Render a .pys or .html file, relative to the document root, into output_buffer.
+    The file runs in a fresh scope holding the helpers plus `variables`.
+    """
+    root = os.path.abspath(current_document_root())
+    full_path = os.path.abspath(os.path.join(root, path.lstrip('/\\')))
+    if os.path.commonpath([root, full_path]) != root:
+        raise IncludeError(f'Include outside of the document root: {path}')
+    if not os.path.isfile(full_path):
+        raise IncludeError(f'Include not found: {path}')
+
+    stack = _include_stack.get()
+    if not stack and 'pyserve.template_path' in request.environ:
+        stack = (request.environ['pyserve.template_path'],)
+    if full_path in stack:
+        raise IncludeError('Include cycle detected: ' + ' -> '.join(
+            os.path.relpath(p, root) for p in stack + (full_path,)))
+    if len(stack) > Config.INCLUDE_MAX_DEPTH:
+        raise IncludeError(f'Include depth limit of {Config.INCLUDE_MAX_DEPTH} exceeded')
+
+    segments = load_template(full_path, parse=get_file_extension(full_path) == 'pys')
+    exec_scope = dict(get_base_namespace()[0])
+    exec_scope.update(variables)
+    token = _include_stack.set(stack + (full_path,))
+    try:
+        for _ in execute_segments(segments, output_buffer, exec_scope):
+            pass
+    finally:
+        _include_stack.reset(token)
+
+
+def render_template(segments):
+    """Execute compiled template segments and return the page text"""
+    return "".join(iter_template(segments))
+
+
+def is_streamable(segments):
+    """Check whether a template may be streamed (streaming enabled and no opt-out marker in the page)"""
+    if not Config.PYS_STREAMING:
+        return False
+    marker = Config.PYS_NO_STREAM_MARKER
+    return not any(kind == "html" and marker in value for kind, value in segments)
 
 
 def extract_all_python_tags(html):
     """Extract the content of all <python> tags from HTML and execute"""
-    parse = extract_python_tags(html)
-    text = ""
-    shared_scope = None
-    for s in parse:
-        if s[0] == "html":
-            text += s[1]
-        elif s[0] == "python":
-            result, shared_scope = run_python(s[1], shared_scope)
-            text += result
-    return text
+    if use_render_pool():
+        return "".join(get_render_pool().render('html', html, False))
+    return render_template(compile_template(html))
+
+
+def render_pys(path, stream=True):
+    """
+    Render a .pys file through the template cache.
+    When streaming is enabled the page is returned as a chunked Response so the
+    static parts reach the client before slow blocks have finished.
+    """
+    segments = load_template(path)
+    stream = stream and is_streamable(segments)
+    request.environ['pyserve.template_path'] = os.path.abspath(path)
+    if use_render_pool():
+        chunks = get_render_pool().render('path', path, stream)
+        if stream:
+            return Response(chunks, mimetype='text/html')
+        return "".join(chunks)
+    if stream:
+        return Response(stream_with_context(iter_template(segments)), mimetype='text/html')
+    return render_template(segments)
+
+# ================
+# Render Workers
+# ================
+
+_in_render_worker = False
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def use_render_pool():
+    """Check whether pages should be rendered by the worker process pool"""
+    return bool(Config.PYS_WORKER_PROCESSES) and not _in_render_worker
+
+
+def snapshot_request():
+    """Return a picklable copy of the current request: (WSGI environ, body)"""
+    body = request.get_data()
+    environ = {
+        key: value for key, value in request.environ.items()
+        if isinstance(value, (str, bytes, int, float, bool, tuple))
+    }
+    return environ, body
+
+
+def _current_rss():
+    """
+    Resident memory of the current process in bytes: /proc on Linux, psutil elsewhere.
+    None when neither is available, which leaves PYS_WORKER_MAX_RSS unenforced
+    (ru_maxrss is the peak, not the current size, and would recycle a worker after every page).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return None
+
+
+def _render_worker_main(conn):
+    """Entry point of a render worker process"""
+    global _in_render_worker
+    _in_render_worker = True
+    get_base_namespace()
+    load_bytecode_cache()
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message[0] == 'stop':
+            break
+        _, kind, source, environ, body, stream = message
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['wsgi.errors'] = sys.stderr
+        try:
+            with app.request_context(environ):
+                segments = load_template(source) if kind == 'path' else compile_template(source)
+                if stream:
+                    for text in iter_template(segments):
+                        conn.send(('chunk', text))
+                else:
+                    conn.send(('chunk', render_template(segments)))
+                timings = request.environ.get('pyserve.timings', [])
+            conn.send(('done', timings, _current_rss()))
+        except Exception as e:
+            conn.send(('error', str(e), [], _current_rss()))
+
+
+class RenderPool:
+    """
+    Pool of pre-started worker processes that render .pys pages.
+    Workers are killed when a page exceeds PYS_WORKER_TIMEOUT and recycled
+    after PYS_WORKER_MAX_RENDERS pages or once their RSS exceeds PYS_WORKER_MAX_RSS.
+    """
+
+    def __init__(self, size):
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            self._context = multiprocessing.get_context('forkserver')
+        else:
+            self._context = multiprocessing.get_context('spawn')
+        self.size = size
+        self.renders = 0
+        self.timeouts = 0
+        self.recycled = 0
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_render_worker_main, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return {'process': process, 'conn': parent_conn, 'renders': 0}
+
+    def _retire(self, worker, graceful):
+        """Stop a worker and start a replacement in the background"""
+        self.recycled += 1
+        if graceful:
+            try:
+                worker['conn'].send(('stop',))
+                worker['process'].join(1)
+            except OSError:
+                pass
+        if worker['process'].is_alive():
+            worker['process'].kill()
+            worker['process'].join(1)
+        worker['conn'].close()
+        threading.Thread(target=lambda: self._idle.put(self._spawn()), daemon=True).start()
+
+    def render(self, kind, source, stream):
+        """
+        Render a page ('path' to a .pys file or 'html' text) in a worker.
+        The request is captured immediately; returns an iterator over the output chunks.
+        """
+        environ, body = snapshot_request()
+        return self._render(('render', kind, source, environ, body, stream))
+
+    def _render(self, message):
+        worker = self._idle.get()
+        deadline = time.monotonic() + Config.PYS_WORKER_TIMEOUT
+        state = 'broken'
+        try:
+            conn = worker['conn']
+            conn.send(message)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not conn.poll(remaining):
+                    self.timeouts += 1
+                    yield '<span class="python-error">Page rendering timed out</span>'
+                    return
+                reply = conn.recv()
+                if reply[0] == 'chunk':
+                    yield reply[1]
+                    continue
+                if reply[0] == 'error':
+                    yield f'<span class="python-error">{html.escape(reply[1])}</span>'
+                for entry in reply[-2]:
+                    record_timing(entry)
+                worker['renders'] += 1
+                self.renders += 1
+                rss = reply[-1]
+                if (Config.PYS_WORKER_MAX_RENDERS and worker['renders'] >= Config.PYS_WORKER_MAX_RENDERS) or (
+                        Config.PYS_WORKER_MAX_RSS and rss and rss > Config.PYS_WORKER_MAX_RSS):
+                    state = 'recycle'
+                else:
+                    state = 'idle'
+                return
+        except (EOFError, OSError):
+            yield '<span class="python-error">Render worker exited unexpectedly</span>'
+        finally:
+            if state == 'idle':
+                self._idle.put(worker)
+            else:
+                self._retire(worker, graceful=state == 'recycle')
+
+    def stats(self):
+        return {
+            'workers': self.size, 'idle': self._idle.qsize(), 'renders': self.renders,
+            'timeouts': self.timeouts, 'recycled': self.recycled
+        }
+
+
+def get_render_pool():
+    """Return the render worker pool, starting it on first use"""
+    global _render_pool
+    if _render_pool is None:
+        with _render_pool_lock:
+            if _render_pool is None:
+                _render_pool = RenderPool(Config.PYS_WORKER_PROCESSES)
+    return _render_pool
+
+# ================
+# Precompiled Templates
+# ================
+
+_BYTECODE_FORMAT = 1
+_BYTECODE_HEADER = b'PYSC' + _BYTECODE_FORMAT.to_bytes(2, 'little') + importlib.util.MAGIC_NUMBER
+
+
+def _bytecode_cache_path(path):
+    return os.path.join(Config.BYTECODE_CACHE_DIR, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.pysc')
+
+
+def write_bytecode_cache(path, identity, segments):
+    """Store the compiled segments of a .pys file in the on-disk bytecode cache"""
+    stored = []
+    for kind, value in segments:
+        if isinstance(value, BaseException):
+            # Blocks that failed to compile are kept as source and compiled again on load
+            stored.append(("error", value.block_source))
+        else:
+            stored.append((kind, value))
+    data = marshal.dumps((path, identity, stored))
+    cache_path = _bytecode_cache_path(path)
+    with open(cache_path + '.tmp', 'wb') as f:
+        f.write(_BYTECODE_HEADER + data)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def load_bytecode_cache():
+    """
+    Load the bytecode cache written by --precompile into the template cache.
+    Entries from another Python version, another cache format or for files
+    changed since they were compiled are ignored.
+    """
+    cache_dir = Config.BYTECODE_CACHE_DIR
+    if not cache_dir or not os.path.isdir(cache_dir) or not Config.TEMPLATE_CACHE_SIZE:
+        return 0
+    loaded = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.pysc'):
+            continue
+        try:
+            with open(os.path.join(cache_dir, name), 'rb') as f:
+                data = f.read()
+            if not data.startswith(_BYTECODE_HEADER):
+                continue
+            path, identity, stored = marshal.loads(data[len(_BYTECODE_HEADER):])
+            st = os.stat(path)
+        except (OSError, ValueError, EOFError, TypeError):
+            continue
+        if (st.st_mtime_ns, st.st_size) != tuple(identity):
+            continue
+        segments = []
+        for kind, value in stored:
+            if kind == "error":
+                segments.append(("python", compile_python_block(value[0], path, value[1])))
+            else:
+                segments.append((kind, value))
+        with _template_cache_lock:
+            _template_cache[(path, True)] = (tuple(identity), segments)
+            while len(_template_cache) > Config.TEMPLATE_CACHE_SIZE:
+                _template_cache.popitem(last=False)
+        loaded += 1
+    return loaded
+
+
+def document_roots():
+    """All local document roots served by this instance"""
+    return [Config.WWW_ROOT]
+
+
+def precompile_www():
+    """
+    Parse and compile every .pys file under the document roots, report syntax
+    errors and write the bytecode cache. Returns the process exit code.
+    """
+    if Config.BYTECODE_CACHE_DIR and not os.path.exists(Config.BYTECODE_CACHE_DIR):
+        os.makedirs(Config.BYTECODE_CACHE_DIR)
+    compiled = 0
+    errors = 0
+    for root in document_roots():
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names.sort()
+            for name in sorted(file_names):
+                if get_file_extension(name) != 'pys':
+                    continue
+                path = os.path.abspath(os.path.join(dir_path, name))
+                try:
+                    st = os.stat(path)
+                    with open(path, 'r', encoding=Config.ENCODING) as f:
+                        segments = compile_template(f.read(), path)
+                except (OSError, UnicodeDecodeError) as e:
+                    print(colorama.Fore.RED + f'{path}: {str(e)}')
+                    errors += 1
+                    continue
+                for kind, value in segments:
+                    if isinstance(value, BaseException):
+                        print(colorama.Fore.RED + f'{path}:{getattr(value, "lineno", "?")}: {getattr(value, "msg", str(value))}')
+                        errors += 1
+                if Config.BYTECODE_CACHE_DIR:
+                    write_bytecode_cache(path, (st.st_mtime_ns, st.st_size), segments)
+                compiled += 1
+    color = colorama.Fore.RED if errors else colorama.Fore.GREEN
+    print(color + f'Precompiled {compiled} file(s), {errors} error(s)' + colorama.Fore.RESET)
+    return 1 if errors else 0
+
+# ================
+# Page Statistics
+# ================
+
+class PageStats:
+    """Per-page and per-block timings of dynamic pages, aggregated across requests"""
+
+    def __init__(self):
+        self.pages = {}  # page -> {'parses', 'parse', 'compile'} (times in ms)
+        self.blocks = {}  # (page, block) -> {'count', 'total', 'max', 'output', 'errors', 'last_error'}
+        self._lock = threading.Lock()
+
+    def record(self, entry):
+        with self._lock:
+            if entry['metric'] == 'block':
+                stats = self.blocks.setdefault((entry['page'], entry['block']), {
+                    'count': 0, 'total': 0.0, 'max': 0.0, 'output': 0, 'errors': 0, 'last_error': None
+                })
+                stats['count'] += 1
+                stats['total'] += entry['dur']
+                stats['max'] = max(stats['max'], entry['dur'])
+                stats['output'] += entry['output']
+                if entry['error']:
+                    stats['errors'] += 1
+                    stats['last_error'] = entry['error']
+            else:
+                stats = self.pages.setdefault(entry['page'], {'parses': 0, 'parse': 0.0, 'compile': 0.0})
+                if entry['metric'] == 'parse':
+                    stats['parses'] += 1
+                stats[entry['metric']] += entry['dur']
+
+    def snapshot(self):
+        with self._lock:
+            return (
+                {page: dict(stats) for page, stats in self.pages.items()},
+                {key: dict(stats) for key, stats in self.blocks.items()}
+            )
+
+
+page_stats = PageStats()
+
+
+def page_label(filename):
+    """Name of a page in timing statistics"""
+    if not filename or filename == '<string>':
+        return request.path if has_request_context() else '<string>'
+    try:
+        return os.path.relpath(filename)
+    except ValueError:
+        # Windows: a document root on another drive than the working directory
+        return os.path.abspath(filename)
+
+
+def record_timing(entry):
+    """Record a parse/compile/block timing for the current request and the aggregated statistics"""
+    page_stats.record(entry)
+    if has_request_context():
+        request.environ.setdefault('pyserve.timings', []).append(entry)
+
+
+_QUOTED_STRING_UNSAFE = re.compile(r'[^\t\x20-\x7e\x80-\xff]')
+_QUOTED_STRING_ESCAPE = re.compile(r'(["\\])')
+
+
+def quoted_string(value):
+    """Quote value as an RFC 9110 quoted-string; characters a header cannot carry become '?'"""
+    return '"' + _QUOTED_STRING_ESCAPE.sub(r'\\\1', _QUOTED_STRING_UNSAFE.sub('?', value)) + '"'
+
+
+def server_timing_header(timings):
+    """Format request timings as a Server-Timing header value"""
+    metrics = []
+    totals = {}
+    for entry in timings:
+        if entry['metric'] == 'block':
+            desc = quoted_string(f"{entry['page']} block {entry['block']}")
+            metrics.append(f'block{len(metrics) + 1};dur={entry["dur"]:.2f};desc={desc}')
+        else:
+            totals[entry['metric']] = totals.get(entry['metric'], 0) + entry['dur']
+    return ', '.join([f'{name};dur={dur:.2f}' for name, dur in totals.items()] + metrics)
+
+
+def generate_stats_page():
+    """HTML page with the aggregated page/block statistics and cache counters"""
+    pages, blocks = page_stats.snapshot()
+    page_rows = "".join(
+        f"<tr><td>{html.escape(page)}</td><td>{stats['parses']}</td>"
+        f"<td>{stats['parse']:.2f}</td><td>{stats['compile']:.2f}</td></tr>"
+        for page, stats in sorted(pages.items())
+    )
+    block_rows = "".join(
+        f"<tr><td>{html.escape(page)}</td><td>{block}</td><td>{stats['count']}</td>"
+        f"<td>{stats['total'] / stats['count']:.2f}</td><td>{stats['max']:.2f}</td>"
+        f"<td>{stats['total']:.2f}</td><td>{stats['output'] // stats['count']}</td>"
+        f"<td>{stats['errors']}</td><td>{html.escape(stats['last_error'] or '')}</td></tr>"
+        for (page, block), stats in sorted(blocks.items(), key=lambda item: -item[1]['total'])
+    )
+    caches = {'Fragment cache': fragment_cache.stats(), 'Response cache': response_cache.stats(),
+              'Static file cache': static_cache.stats(), 'Compressed file cache': compressed_cache.stats(),
+              'Path cache': path_cache.stats()}
+    if _render_pool is not None:
+        caches['Render workers'] = _render_pool.stats()
+    if _fastcgi_pool is not None:
+        caches['PHP FastCGI workers'] = _fastcgi_pool.stats()
+    caches['PHP admission'] = php_admission.stats()
+    cache_rows = "".join(
+        f"<tr><td>{name}</td><td>{html.escape(str(stats))}</td></tr>" for name, stats in caches.items()
+    )
+    return f"""
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Server statistics</title>
+    <style>
+        body {{ font-family: sans-serif; line-height: 1.5; }}
+        table {{ border-collapse: collapse; margin-bottom: 20px; }}
+        td, th {{ border: 1px solid #ccc; padding: 2px 8px; text-align: left; }}
+    </style>
+</head>
+<body>
+    <h1>Blocks</h1>
+    <table>
+        <tr><th>Page</th><th>Block</th><th>Runs</th><th>Avg ms</th><th>Max ms</th><th>Total ms</th><th>Avg output chars</th><th>Errors</th><th>Last error</th></tr>
+        {block_rows}
+    </table>
+    <h1>Pages</h1>
+    <table>
+        <tr><th>Page</th><th>Parses</th><th>Parse ms</th><th>Compile ms</th></tr>
+        {page_rows}
+    </table>
+    <h1>Caches</h1>
+    <table>
+        {cache_rows}
+    </table>
+</body>
+</html>
+"""
+
+# ================
+# FastCGI
+# ================
+
+FCGI_VERSION = 1
+FCGI_BEGIN_REQUEST = 1
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+FCGI_RESPONDER = 1
+FCGI_HEADER = struct.Struct('!BBHHBx')
+FCGI_MAX_CONTENT = 65535
+
+_fastcgi_pool = None
+_fastcgi_pool_lock = threading.Lock()
+
+
+class FastCGIError(Exception):
+    """Malformed or missing reply from a FastCGI worker"""
+
+
+def fcgi_record(record_type, content=b'', request_id=1):
+    """Encode content as one or more FastCGI records (an empty content gives a single empty record)"""
+    chunks = [content[i:i + FCGI_MAX_CONTENT] for i in range(0, len(content), FCGI_MAX_CONTENT)] or [b'']
+    return b''.join(
+        FCGI_HEADER.pack(FCGI_VERSION, record_type, request_id, len(chunk), -len(chunk) % 8)
+        + chunk + b'\0' * (-len(chunk) % 8)
+        for chunk in chunks
+    )
+
+
+def fcgi_params(env):
+    """Encode a CGI environment as FastCGI name-value pairs"""
+    data = []
+    for name, value in env.items():
+        name, value = str(name).encode('utf-8'), str(value).encode('utf-8', 'surrogateescape')
+        for length in (len(name), len(value)):
+            data.append(bytes([length]) if length < 128 else struct.pack('!I', length | 0x80000000))
+        data.append(name)
+        data.append(value)
+    return b''.join(data)
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise FastCGIError('FastCGI worker closed the connection')
+        data += chunk
+    return data
+
+
+class FastCGIPool:
+    """
+    Pool of long-lived php-cgi -b processes (or an external php-fpm at PHP_FASTCGI_ADDRESS).
+    Each worker serves one request at a time; workers are recycled after
+    PHP_FASTCGI_MAX_REQUESTS requests and respawned when a health check finds them dead.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.requests = 0
+        self.errors = 0
+        self.restarts = 0
+        self._closed = False
+        self._socket_dir = None
+        if not Config.PHP_FASTCGI_ADDRESS and hasattr(socket, 'AF_UNIX'):
+            self._socket_dir = Config.PHP_FASTCGI_SOCKET_DIR or tempfile.mkdtemp(prefix='pyserve-php-')
+            os.makedirs(self._socket_dir, exist_ok=True)
+        self._workers = [self._spawn(index) for index in range(size)]
+        self._idle = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        atexit.register(self.close)
+        if Config.PHP_FASTCGI_HEALTH_INTERVAL:
+            threading.Thread(target=self._health_loop, daemon=True).start()
+
+    def _address(self, index):
+        if Config.PHP_FASTCGI_ADDRESS:
+            address = Config.PHP_FASTCGI_ADDRESS
+        elif self._socket_dir:
+            return os.path.join(self._socket_dir, f'php-{index}.sock')
+        else:
+            address = f'127.0.0.1:{Config.PHP_FASTCGI_PORT + index}'
+        if ':' in address and not address.startswith('/'):
+            host, port = address.rsplit(':', 1)
+            return host, int(port)
+        return address
+
+    def _spawn(self, index):
+        worker = {'index': index, 'address': self._address(index), 'process': None, 'requests': 0}
+        if Config.PHP_FASTCGI_ADDRESS:
+            return worker
+        address = worker['address']
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            bind = address
+        else:
+            bind = f'{address[0]}:{address[1]}'
+        env = dict(inherited_environ(), PHP_FCGI_CHILDREN='0', PHP_FCGI_MAX_REQUESTS='0')
+        worker['process'] = subprocess.Popen(
+            [Config.PHP_CGI_PATH, '-b', bind], env=env,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL
+        )
+        return worker
+
+    def _stop(self, worker):
+        process = worker['process']
+        if process is not None and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(1)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def _restart(self, worker):
+        """Replace a worker process with a fresh one"""
+        self._stop(worker)
+        self.restarts += 1
+        fresh = self._spawn(worker['index'])
+        self._workers[worker['index']] = fresh
+        return fresh
+
+    def _connect(self, worker, timeout):
+        """Connect to a worker, waiting for a freshly started process to listen"""
+        address = worker['address']
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(address)
+                return sock
+            except OSError:
+                sock.close()
+                process = worker['process']
+                if time.monotonic() > deadline or (process is not None and process.poll() is not None):
+                    raise
+                time.sleep(0.02)
+
+    def _healthy(self, worker):
+        if worker['process'] is not None and worker['process'].poll() is not None:
+            return False
+        try:
+            self._connect(worker, 1).close()
+            return True
+        except OSError:
+            return False
+
+    def _health_loop(self):
+        while not self._closed:
+            time.sleep(Config.PHP_FASTCGI_HEALTH_INTERVAL)
+            checked = []
+            try:
+                for _ in range(self.size):
+                    worker = self._idle.get_nowait()
+                    if not self._closed and not self._healthy(worker):
+                        app.logger.warning(f"PHP FastCGI worker {worker['index']} is not responding, restarting")
+                        worker = self._restart(worker)
+                    checked.append(worker)
+            except queue.Empty:
+                pass
+            for worker in checked:
+                self._idle.put(worker)
+
+    def request(self, env, body=None):
+        """
+        Run one request on an idle worker, sending body (an iterable of byte chunks) as stdin.
+        Yields ('stdout', bytes) and ('stderr', bytes) as they arrive, then ('end', app_status).
+        """
+        worker = self._idle.get()
+        state = 'broken'
+        sock = None
+        try:
+            if worker['process'] is not None and worker['process'].poll() is not None:
+                worker = self._restart(worker)
+            sock = self._connect(worker, Config.PHP_FASTCGI_TIMEOUT)
+            sock.sendall(
+                fcgi_record(FCGI_BEGIN_REQUEST, struct.pack('!HB5x', FCGI_RESPONDER, 0))
+                + fcgi_record(FCGI_PARAMS, fcgi_params(env)) + fcgi_record(FCGI_PARAMS)
+            )
+            for chunk in body or ():
+                if chunk:
+                    sock.sendall(fcgi_record(FCGI_STDIN, chunk))
+            sock.sendall(fcgi_record(FCGI_STDIN))
+            while True:
+                version, record_type, _, length, padding = FCGI_HEADER.unpack(_recv_exact(sock, FCGI_HEADER.size))
+                content = _recv_exact(sock, length + padding)[:length]
+                if record_type == FCGI_STDOUT and content:
+                    yield 'stdout', content
+                elif record_type == FCGI_STDERR and content:
+                    yield 'stderr', content
+                elif record_type == FCGI_END_REQUEST:
+                    state = 'idle'
+                    yield 'end', struct.unpack('!I', content[:4])[0]
+                    return
+        finally:
+            if sock is not None:
+                sock.close()
+            self.requests += 1
+            worker['requests'] += 1
+            if state != 'idle':
+                self.errors += 1
+            if not self._closed and worker['process'] is not None and (state != 'idle' or (
+                    Config.PHP_FASTCGI_MAX_REQUESTS and worker['requests'] >= Config.PHP_FASTCGI_MAX_REQUESTS)):
+                worker = self._restart(worker)
+            self._idle.put(worker)
+
+    def close(self):
+        self._closed = True
+        for worker in self._workers:
+            self._stop(worker)
+            if isinstance(worker['address'], str) and worker['process'] is not None and os.path.exists(worker['address']):
+                os.remove(worker['address'])
+
+    def stats(self):
+        return {
+            'workers': self.size, 'idle': self._idle.qsize(), 'requests': self.requests,
+            'errors': self.errors, 'restarts': self.restarts
+        }
+
+
+def get_fastcgi_pool():
+    """Return the PHP FastCGI worker pool, starting it on first use"""
+    global _fastcgi_pool
+    if _fastcgi_pool is None:
+        with _fastcgi_pool_lock:
+            if _fastcgi_pool is None:
+                _fastcgi_pool = FastCGIPool(Config.PHP_FASTCGI_WORKERS)
+    return _fastcgi_pool
+
 
 # ================
 # PHP Interpreter
 # ================
 
 
-def run_php(filepath):
-    filepath = filepath.replace('\\','/')
-    filename = filepath.split('/')[-1]
-    env = {
-        'GATEWAY_INTERFACE': 'CGI/1.1',
-        'SERVER_SOFTWARE': 'Flask/PyServe',
-        'SERVER_NAME': request.host.split(':')[0],
-        'SERVER_PORT': str(request.host.split(':')[1] if ':' in request.host else '80'),
+_php_env_templates = {}
+
+
+def inherited_environ():
+    """Variables of the server's own environment that are passed on to PHP (PHP_ENV_ALLOWLIST)"""
+    allowed = {name.upper() for name in Config.PHP_ENV_ALLOWLIST}
+    return {name: value for name, value in os.environ.items() if name.upper() in allowed}
+
+
+def php_env_template(document_root):
+    """The request-independent part of the CGI environment for a document root, computed once"""
+    # Same normalisation as serve(), so templates warmed at startup are the ones requests find
+    document_root = document_root.replace('/','\\')
+    template = _php_env_templates.get(document_root)
+    if template is None:
+        template = inherited_environ()
+        template.update({
+            'GATEWAY_INTERFACE': 'CGI/1.1',
+            'SERVER_SOFTWARE': 'Flask/PyServe',
+            'DOCUMENT_ROOT': os.path.abspath(document_root),
+            'REDIRECT_STATUS': '0'
+        })
+        template = _php_env_templates.setdefault(document_root, template)
+    return template
+
+
+def php_environ(filepath):
+    """CGI environment and request body for running a PHP file"""
+    env = dict(php_env_template(Config.WWW_ROOT))
+    # All request headers are forwarded as HTTP_*, except Proxy (httpoxy)
+    env.update((key, value) for key, value in request.environ.items()
+               if key.startswith('HTTP_') and key != 'HTTP_PROXY')
+    server_name, _, server_port = request.host.partition(':')
+    remote_addr = request.remote_addr
+    env.update({
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': server_port or '80',
         'SERVER_PROTOCOL': request.environ.get('SERVER_PROTOCOL', 'HTTP/1.1'),
         'REQUEST_URI': request.full_path,
-        'REMOTE_ADDR': request.remote_addr,
-        'REMOTE_HOST': request.remote_addr,
+        'REMOTE_ADDR': remote_addr,
+        'REMOTE_HOST': remote_addr,
         'SCRIPT_NAME': request.path,
         'SCRIPT_FILENAME': os.path.abspath(filepath),
-        'DOCUMENT_ROOT': os.path.abspath(Config.WWW_ROOT),
         'REQUEST_METHOD': request.method,
         'QUERY_STRING': request.query_string.decode('utf-8'),
         'CONTENT_TYPE': request.headers.get('Content-Type', ''),
-        'REDIRECT_STATUS': '0', 
-        'HTTP_USER_AGENT': request.headers.get('User-Agent', ''),
-        'HTTP_ACCEPT': request.headers.get('Accept', ''),
-        'HTTP_ACCEPT_LANGUAGE': request.headers.get('Accept-Language', ''),
-        'HTTP_ACCEPT_ENCODING': request.headers.get('Accept-Encoding', ''),
-        'HTTP_CONNECTION': request.headers.get('Connection', ''),
-        'HTTP_HOST': request.headers.get('Host', ''),
-        'PATH_INFO': filename,
-        **os.environ
-    }
+        'PATH_INFO': os.path.basename(filepath.replace('\\', '/'))
+    })
     stdin_data = None
     if request.method in ['POST', 'PUT', 'PATCH']:
-        content_type = request.content_type
-        if 'application/x-www-form-urlencoded' in content_type:
-            stdin_data = request.get_data()
-        elif 'multipart/form-data' in content_type:
-            stdin_data = request.get_data()
-        elif 'application/json' in content_type:
-            stdin_data = request.get_data()
-        else:
-            stdin_data = request.get_data()
-        env['CONTENT_LENGTH'] = str(len(stdin_data)) if stdin_data else '0'
-    app.logger.debug(f"PHP Request: {env}")
-    app.logger.debug(f"POST Data: {stdin_data}")
+        stdin_data, length = php_request_body()
+        env['CONTENT_LENGTH'] = str(length)
+    return env, stdin_data
+
+
+def _read_chunks(stream, length):
     try:
-        result = subprocess.run(
-            [Config.PHP_CGI_PATH],
-            env=env,
-            input=stdin_data if stdin_data else None,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=10
-        )
+        while length > 0:
+            chunk = stream.read(min(PHP_BODY_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        if isinstance(stream, tempfile.SpooledTemporaryFile):
+            stream.close()
 
-        app.logger.debug(f"PHP Exit Code: {result.returncode}")
-        app.logger.debug(f"PHP Output: {result.stdout[:200]}")
-        app.logger.debug(f"PHP Error: {result.stderr[:200]}")
 
-        if result.returncode != 0:
-            error_msg = result.stderr.decode('utf-8', 'ignore') or "Unknown PHP error"
-            return f"PHP Execution Error (Code {result.returncode}): {error_msg}", 500
+def php_request_body():
+    """
+    Return (chunk iterator, length) of the request body for PHP stdin.
+    The body is read from the WSGI input as PHP consumes it; a body without
+    Content-Length (chunked upload) is spooled to a temporary file first.
+    Aborts with 413 when the body exceeds PHP_MAX_BODY_SIZE.
+    """
+    length = request.content_length
+    if length is not None:
+        if Config.PHP_MAX_BODY_SIZE is not None and length > Config.PHP_MAX_BODY_SIZE:
+            abort(413)
+        return _read_chunks(request.stream, length), length
+    spool = tempfile.SpooledTemporaryFile(max_size=PHP_BODY_SPOOL_SIZE)
+    length = 0
+    for chunk in iter(lambda: request.stream.read(PHP_BODY_CHUNK_SIZE), b''):
+        length += len(chunk)
+        if Config.PHP_MAX_BODY_SIZE is not None and length > Config.PHP_MAX_BODY_SIZE:
+            spool.close()
+            abort(413)
+        spool.write(chunk)
+    spool.seek(0)
+    return _read_chunks(spool, length), length
 
-        output = result.stdout
+
+def run_php(filepath):
+    output = php_output(filepath)
+    try:
+        output = b''.join(output)
+        app.logger.debug(f"PHP Output: {output[:200]}")
 
         if b'\r\n\r\n' in output:
             headers, body = output.split(b'\r\n\r\n', 1)
@@ -470,18 +1725,1568 @@ def run_php(filepath):
         
         return response, body.decode()
 
+    except PHPError as e:
+        return str(e), 500
+    except Exception as e:
+        app.logger.error(f"Server Error: {str(e)}")
+        return f"Server Error: {str(e)}", 500
+
+
+class PHPError(Exception):
+    """PHP failed before producing any output"""
+
+
+_CGI_HEADER_END = re.compile(rb'\r?\n\r?\n')
+CGI_MAX_HEADER_SIZE = 64 * 1024
+PHP_BODY_CHUNK_SIZE = 64 * 1024
+PHP_BODY_SPOOL_SIZE = 1024 * 1024
+
+
+class AdmissionController:
+    """
+    Limits the number of PHP executions running at once.
+    Requests over the limit wait in a bounded queue, highest priority first
+    (first come first served within a priority); a request is rejected when
+    the queue is full or it has waited longer than the queue timeout.
+    """
+
+    def __init__(self):
+        self.running = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.queue_time = 0.0
+        self.queue_time_max = 0.0
+        self.exec_time = 0.0
+        self.exec_time_max = 0.0
+        self._waiting = []  # heap of [-priority, sequence, event]
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def acquire(self, priority=0):
+        """Wait for an execution slot; returns the time spent queued, or None if rejected"""
+        with self._lock:
+            if not Config.PHP_MAX_CONCURRENCY or (self.running < Config.PHP_MAX_CONCURRENCY and not self._waiting):
+                self.running += 1
+                self.admitted += 1
+                return 0.0
+            if len(self._waiting) >= Config.PHP_QUEUE_SIZE:
+                self.rejected += 1
+                return None
+            waiter = [-priority, next(self._sequence), threading.Event()]
+            heapq.heappush(self._waiting, waiter)
+        start = time.monotonic()
+        if not waiter[2].wait(Config.PHP_QUEUE_TIMEOUT):
+            with self._lock:
+                if not waiter[2].is_set():
+                    self._waiting.remove(waiter)
+                    heapq.heapify(self._waiting)
+                    self.timed_out += 1
+                    return None
+        waited = time.monotonic() - start
+        with self._lock:
+            self.admitted += 1
+            self.queue_time += waited
+            self.queue_time_max = max(self.queue_time_max, waited)
+        return waited
+
+    def release(self, exec_time):
+        """Free a slot, handing it to the highest-priority waiting request"""
+        with self._lock:
+            self.exec_time += exec_time
+            self.exec_time_max = max(self.exec_time_max, exec_time)
+            if self._waiting:
+                heapq.heappop(self._waiting)[2].set()
+            else:
+                self.running -= 1
+
+    def stats(self):
+        with self._lock:
+            admitted = self.admitted or 1
+            return {
+                'running': self.running, 'waiting': len(self._waiting), 'admitted': self.admitted,
+                'rejected': self.rejected, 'timed_out': self.timed_out,
+                'avg_queue_ms': round(self.queue_time / admitted * 1000, 2),
+                'max_queue_ms': round(self.queue_time_max * 1000, 2),
+                'avg_exec_ms': round(self.exec_time / admitted * 1000, 2),
+                'max_exec_ms': round(self.exec_time_max * 1000, 2)
+            }
+
+
+php_admission = AdmissionController()
+
+
+def php_priority(url_path):
+    """Return the admission priority configured for a URL path (higher runs first)"""
+    for pattern, priority in Config.PHP_PRIORITIES.items():
+        if fnmatch.fnmatchcase(url_path, pattern):
+            return priority
+    return 0
+
+
+def _admitted(output, started):
+    try:
+        yield from output
+    finally:
+        output.close()
+        php_admission.release(time.monotonic() - started)
+
+
+def php_output(filepath):
+    """
+    Run a PHP file (php-cgi per request, or the FastCGI pool) and return an
+    iterator over its raw stdout as it is produced. The request body is fed
+    to PHP while it runs. php-cgi is killed when it produces no output for
+    PHP_TIMEOUT seconds, once it has run for PHP_MAX_EXECUTION_TIME seconds,
+    or when the iterator is closed.
+    Aborts with 503 when the admission controller rejects the request.
+    """
+    env, stdin_data = php_environ(filepath)
+    app.logger.debug(f"PHP Request: {env['REQUEST_METHOD']} {env['SCRIPT_FILENAME']}")
+    if php_admission.acquire(php_priority(request.path)) is None:
+        body, status = serve_error_page(503)
+        abort(make_response(body, status, {'Retry-After': str(Config.PHP_RETRY_AFTER)}))
+    if Config.PHP_FASTCGI:
+        output = _fastcgi_output(env, stdin_data)
+    else:
+        output = _cgi_output(filepath, env, stdin_data)
+    return _admitted(output, time.monotonic())
+
+
+def _fastcgi_output(env, stdin_data):
+    produced = False
+    errors = []
+    for kind, data in get_fastcgi_pool().request(env, stdin_data):
+        if kind == 'stdout':
+            produced = True
+            yield data
+        elif kind == 'stderr':
+            errors.append(data)
+        elif errors:
+            error_msg = b''.join(errors).decode('utf-8', 'ignore')
+            app.logger.debug(f"PHP Error: {error_msg[:200]}")
+            if not produced:
+                raise PHPError(f"PHP Execution Error (Code {data}): {error_msg}")
+
+
+def _cgi_output(filepath, env, stdin_data):
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        [Config.PHP_CGI_PATH],
+        env=env,
+        stdin=subprocess.DEVNULL if stdin_data is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=stderr
+    )
+    # Time of the last progress: output read from PHP or request body written to it
+    last_activity = [time.monotonic()]
+    deadline = last_activity[0] + Config.PHP_MAX_EXECUTION_TIME if Config.PHP_MAX_EXECUTION_TIME else None
+    killed = []
+
+    def feed():
+        # A script that never reads stdin blocks this write; the watchdog still runs and kills it
+        try:
+            for chunk in stdin_data:
+                process.stdin.write(chunk)
+                last_activity[0] = time.monotonic()
+        except OSError:
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    def watch():
+        # The inactivity timeout applies on top of the hard limit on total run time
+        while True:
+            kill_at = last_activity[0] + Config.PHP_TIMEOUT
+            if deadline is not None:
+                kill_at = min(kill_at, deadline)
+            try:
+                process.wait(max(0.0, kill_at - time.monotonic()))
+                return
+            except subprocess.TimeoutExpired:
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    killed.append(f"ran longer than {Config.PHP_MAX_EXECUTION_TIME}s")
+                elif now - last_activity[0] >= Config.PHP_TIMEOUT:
+                    killed.append(f"no output for {Config.PHP_TIMEOUT}s")
+                else:
+                    continue
+                app.logger.error(f"PHP timed out ({killed[0]}): {filepath}")
+                process.kill()
+                return
+
+    if stdin_data is not None:
+        threading.Thread(target=feed, daemon=True).start()
+    threading.Thread(target=watch, daemon=True).start()
+    produced = False
+    try:
+        while True:
+            chunk = process.stdout.read1(65536)
+            if not chunk:
+                break
+            last_activity[0] = time.monotonic()
+            produced = True
+            yield chunk
+        returncode = process.wait()
+        app.logger.debug(f"PHP Exit Code: {returncode}")
+        if killed:
+            # Buffered callers turn this into a 500; a streamed response is cut short
+            raise PHPError(f"PHP Execution Error: timed out, {killed[0]}")
+        if returncode != 0 and not produced:
+            stderr.seek(0)
+            error_msg = stderr.read().decode('utf-8', 'ignore') or "Unknown PHP error"
+            raise PHPError(f"PHP Execution Error (Code {returncode}): {error_msg}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+        stderr.close()
+
+
+def parse_cgi_headers(block):
+    """Parse a CGI header block into (status, headers), honouring Status: and Location:"""
+    status = None
+    headers = []
+    for line in re.split(rb'\r?\n', block):
+        if b':' not in line:
+            continue
+        key, value = line.split(b':', 1)
+        key, value = key.strip().decode('latin-1'), value.strip().decode('latin-1')
+        if key.lower() == 'status':
+            status = value if value[:3].isdigit() else None
+        elif key.lower() != 'connection':
+            headers.append((key, value))
+    if status is None:
+        status = 302 if any(key.lower() == 'location' for key, _ in headers) else 200
+    return status, headers
+
+
+def read_cgi_headers(output):
+    """
+    Read PHP output until its CGI header block is complete.
+    Returns (status, headers, body bytes read so far); output continues with the rest of the body.
+    """
+    buffer = b''
+    for chunk in output:
+        searched = max(0, len(buffer) - 3)
+        buffer += chunk
+        match = _CGI_HEADER_END.search(buffer, searched)
+        if match or len(buffer) > CGI_MAX_HEADER_SIZE:
+            break
+    else:
+        match = _CGI_HEADER_END.search(buffer)
+    if match:
+        status, headers = parse_cgi_headers(buffer[:match.start()])
+        return status, headers, buffer[match.end():]
+    return 200, [], buffer
+
+
+def php_response(filepath, stream=True):
+    """
+    Run a PHP file and build the response from its CGI output. The header
+    block is parsed as soon as it arrives; with stream the body bytes are then
+    passed to the client as PHP produces them.
+    """
+    output = php_output(filepath)
+    try:
+        status, headers, body = read_cgi_headers(output)
+    except PHPError as e:
+        return str(e), 500
     except Exception as e:
+        output.close()
         app.logger.error(f"Server Error: {str(e)}")
         return f"Server Error: {str(e)}", 500
 
+    if not stream:
+        try:
+            body += b''.join(output)
+        except Exception as e:
+            app.logger.error(f"Server Error: {str(e)}")
+            return f"Server Error: {str(e)}", 500
+        return Response(body, status=status, headers=headers)
+
+    def generate():
+        try:
+            if body:
+                yield body
+            yield from output
+        except Exception as e:
+            app.logger.error(f"PHP output interrupted: {str(e)}")
+        finally:
+            output.close()
+
+    return Response(generate(), status=status, headers=headers)
+
 
 # ================
 # pp File
 # ================
 
-def run_pp(file_path):
-    html = run_php(file_path)[1]
-    return extract_all_python_tags(html)
+_PP_TAG_CANDIDATE = re.compile(rb'<(?:!\[CDATA\[|!--|script|style|python>|/python>)', re.IGNORECASE)
+_PP_COMMENT_EVENT = re.compile(rb'-->|<!\[CDATA\[')
+_PP_TAG_END_EVENT = re.compile(rb'[>"\']')
+_PP_STRING_END = {q: re.compile(rb'[\\' + q + rb']') for q in (b'"', b"'", b'`')}
+_PP_RAW_TEXT_EVENT = {
+    tag: re.compile(re.escape(tag) + rb'|["\'`]', re.IGNORECASE)
+    for tag in (b'</script>', b'</style>')
+}
+_PP_TAG_DELIMITERS = b' \t\n\r>/'
+_PP_LOOKBEHIND = 8  # longest tag candidate minus one
+
+
+class PPTokenizer:
+    """
+    Resumable bytes-level version of extract_python_tags() for the PHP output of .pp files.
+    Feed the output chunk by chunk; each call returns the segments completed so far:
+    ("html", bytes) spans passed through undecoded, and ("python", str) blocks.
+    Static text is released as soon as it can no longer become part of a block.
+    After close() the segments are the same as extract_python_tags() on the whole
+    decoded output, except that static text may be split across several segments.
+    """
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self._data = b''
+        self._i = 0
+        self._html_start = 0
+        self._python_start = -1
+        self._python_depth = 0
+        self._in_comment = False
+        self._in_script = False
+        self._in_style = False
+        self._in_cdata = False
+        self._in_python_tag = False
+
+    def feed(self, data):
+        self._data += data
+        results = self._scan(final=False)
+        if not self._in_python_tag:
+            self._flush_html(self._i, results)
+        base = self._python_start if self._in_python_tag else self._html_start
+        if base:
+            self._data = self._data[base:]
+            self._i -= base
+            self._html_start -= base
+            if self._in_python_tag:
+                self._python_start -= base
+        return results
+
+    def close(self):
+        results = self._scan(final=True)
+        if self._in_python_tag:
+            results.append(("python", f'echo("<span class="python-warning">Unclosed <python> tag detected (depth={self._python_depth}), content discarded.</span>")'))
+        else:
+            self._flush_html(len(self._data), results)
+        self._data = b''
+        return results
+
+    def _flush_html(self, end, results):
+        chunk = self._data[self._html_start:end]
+        if chunk:
+            results.append(("html", chunk))
+        self._html_start = end
+
+    @staticmethod
+    def _find_tag_end(data, start):
+        i = start
+        while True:
+            m = _PP_TAG_END_EVENT.search(data, i)
+            if m is None:
+                return -1
+            i = m.start()
+            c = data[i:i + 1]
+            if c == b'>':
+                return i
+            i = data.find(c, i + 1)
+            if i == -1:
+                return -1
+            i += 1
+
+    @staticmethod
+    def _find_raw_text_end(data, i, end_tag):
+        length = len(data)
+        event = _PP_RAW_TEXT_EVENT[end_tag]
+        while i < length:
+            m = event.search(data, i)
+            if m is None:
+                return -1
+            i = m.start()
+            string_char = data[i:i + 1]
+            if string_char == b'<':
+                return i
+            string_end = _PP_STRING_END[string_char]
+            i += 1
+            while True:
+                m = string_end.search(data, i)
+                if m is None:
+                    return -1
+                i = m.start()
+                if data[i:i + 1] == b'\\':
+                    i += 2
+                    continue
+                i += 1
+                break
+        return -1
+
+    def _scan(self, final):
+        """
+        Advance the scanner over the buffered data. Without final, a construct
+        whose end is not buffered yet suspends the scan until more data arrives.
+        """
+        data = self._data
+        length = len(data)
+        i = self._i
+        results = []
+        while i < length:
+            if self._in_cdata:
+                end_pos = data.find(b']]>', i)
+                if end_pos == -1:
+                    if not final:
+                        i = max(i, length - 2)
+                    break
+                self._in_cdata = False
+                i = end_pos + 3
+                continue
+            if self._in_script or self._in_style or self._in_comment:
+                # CDATA is recognised at the current position before anything else
+                if data.startswith(b'<![CDATA[', i):
+                    self._in_cdata = True
+                    i += 9
+                    continue
+                if self._in_comment:
+                    m = _PP_COMMENT_EVENT.search(data, i)
+                    if m is None:
+                        if not final:
+                            i = max(i, length - _PP_LOOKBEHIND)
+                        break
+                    i = m.start()
+                    if data[i:i + 1] == b'-':
+                        self._in_comment = False
+                        i += 3
+                    else:
+                        self._in_cdata = True
+                        i += 9
+                    continue
+                end_tag = b'</script>' if self._in_script else b'</style>'
+                end_pos = self._find_raw_text_end(data, i, end_tag)
+                if end_pos == -1:
+                    break
+                self._in_script = self._in_style = False
+                i = end_pos + len(end_tag)
+                continue
+            m = _PP_TAG_CANDIDATE.search(data, i)
+            if m is None:
+                if not final:
+                    i = max(i, length - _PP_LOOKBEHIND)
+                break
+            i = m.start()
+            if data.startswith(b'<![CDATA[', i):
+                self._in_cdata = True
+                i += 9
+                continue
+            if data.startswith(b'<!--', i):
+                self._in_comment = True
+                i += 4
+                continue
+            if not self._in_python_tag:
+                if data[i:i + 7].lower() == b'<script':
+                    tag_end = i + 7
+                elif data[i:i + 6].lower() == b'<style':
+                    tag_end = i + 6
+                else:
+                    tag_end = -1
+                if tag_end != -1:
+                    if tag_end >= length and not final:
+                        break
+                    if tag_end >= length or data[tag_end:tag_end + 1] in _PP_TAG_DELIMITERS:
+                        close = self._find_tag_end(data, tag_end)
+                        if close != -1:
+                            self._in_script = tag_end == i + 7
+                            self._in_style = not self._in_script
+                            i = close + 1
+                        elif not final:
+                            break
+                        else:
+                            i += 1
+                        continue
+            if data[i:i + 8].lower() == b'<python>':
+                if not self._in_python_tag:
+                    self._flush_html(i, results)
+                    self._html_start = i + 8
+                    self._in_python_tag = True
+                    self._python_start = i + 8
+                    self._python_depth = 1
+                else:
+                    self._python_depth += 1
+                i += 8
+                continue
+            if self._in_python_tag and data[i:i + 9].lower() == b'</python>':
+                self._python_depth -= 1
+                if self._python_depth == 0:
+                    content = data[self._python_start:i].decode(self.encoding, 'replace')
+                    results.append(("python", content))
+                    self._in_python_tag = False
+                    self._python_start = -1
+                    self._html_start = i + 9
+                i += 9
+                continue
+            i += 1
+        self._i = i
+        return results
+
+
+def cache_control_directives(headers):
+    """Directives of the Cache-Control header in a list of (name, value) headers, as {name: value}"""
+    cache_control = {}
+    for key, value in headers:
+        if key.lower() != 'cache-control':
+            continue
+        for directive in value.lower().split(','):
+            name, _, argument = directive.strip().partition('=')
+            cache_control[name] = argument.strip('"')
+    return cache_control
+
+
+def is_shareable(headers):
+    """False for responses that must not be served to other clients: Set-Cookie, no-store, no-cache or private"""
+    headers = list(headers)
+    if any(key.lower() == 'set-cookie' for key, value in headers):
+        return False
+    return not cache_control_directives(headers).keys() & {'no-store', 'no-cache', 'private'}
+
+
+def cgi_cache_ttl(status, headers):
+    """Seconds a CGI response may be reused according to its Cache-Control/Expires headers, or None"""
+    if str(status)[:3] != '200' or not is_shareable(headers):
+        return None
+    values = {key.lower(): value for key, value in headers}
+    cache_control = cache_control_directives(headers)
+    for name in ('s-maxage', 'max-age'):
+        if cache_control.get(name, '').isdigit():
+            return int(cache_control[name]) or None
+    if 'expires' in values:
+        try:
+            expires = email.utils.parsedate_to_datetime(values['expires']).timestamp()
+        except (TypeError, ValueError):
+            return None
+        return max(0, int(expires - time.time())) or None
+    return None
+
+
+def _pp_body(body, output, key=None, ttl=None):
+    chunks = [] if ttl else None
+    try:
+        for chunk in itertools.chain((body,), output):
+            if chunks is not None:
+                chunks.append(chunk)
+            yield chunk
+    finally:
+        output.close()
+    if chunks is not None:
+        fragment_cache.set(key, b''.join(chunks), ttl=ttl)
+
+
+def pp_output(file_path):
+    """
+    Run the PHP stage of a .pp file and return an iterator over its body bytes.
+    With PP_CACHE_PHP_OUTPUT, output that PHP marks as cacheable (Cache-Control
+    max-age or Expires) is kept in the fragment cache and reused instead of
+    running PHP again.
+    """
+    key = None
+    if Config.PP_CACHE_PHP_OUTPUT and request.method in ('GET', 'HEAD'):
+        st = os.stat(file_path)
+        key = ('php-output', os.path.abspath(file_path), st.st_mtime_ns, st.st_size, response_cache_key())
+        cached = fragment_cache.get(key)
+        if cached is not None:
+            return iter((cached[0],))
+    output = php_output(file_path)
+    try:
+        status, headers, body = read_cgi_headers(output)
+    except Exception:
+        output.close()
+        raise
+    ttl = cgi_cache_ttl(status, headers) if key else None
+    return _pp_body(body, output, key, ttl)
+
+
+def iter_pp(chunks, filename='<string>'):
+    """
+    Run the <python> blocks of PHP output arriving as byte chunks and yield the page as bytes.
+    Static spans are passed through as they are; only the blocks are decoded and executed.
+    """
+    tokenizer = PPTokenizer()
+    output = new_output_buffer()
+    exec_scope = None
+    block = 0
+    line = 1
+    try:
+        for chunk in itertools.chain(chunks, (None,)):
+            for kind, value in tokenizer.feed(chunk) if chunk is not None else tokenizer.close():
+                if kind == "html":
+                    line += value.count(b'\n')
+                    try:
+                        output.reserve(len(value))
+                    except OutputLimitError as e:
+                        output.write_error(e)
+                        yield output.flush().encode('utf-8')
+                        return
+                    yield value
+                    continue
+                block += 1
+                code = compile_python_block(value, filename, line)
+                line += value.count('\n')
+                exec_scope = run_python(code, output, exec_scope, block)
+                text = output.flush()
+                if text:
+                    yield text.encode('utf-8')
+                if output.exceeded:
+                    return
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def run_pp(file_path, stream=False):
+    """Run a .pp file: PHP renders it first, then the <python> blocks of its output are executed"""
+    if use_render_pool():
+        html = run_php(file_path)[1]
+        return extract_all_python_tags(html)
+    try:
+        chunks = pp_output(file_path)
+    except PHPError as e:
+        return str(e), 500
+    except HTTPException:
+        # abort() from admission control (503) or the request body limit (413)
+        raise
+    except Exception as e:
+        app.logger.error(f"Server Error: {str(e)}")
+        return f"Server Error: {str(e)}", 500
+    page = iter_pp(chunks, file_path)
+    if stream and Config.PHP_STREAMING:
+        return Response(stream_with_context(page), mimetype='text/html')
+    return b''.join(page)
+
+
+# ================
+# Response Cache
+# ================
+
+class ResponseCache:
+    """
+    Cache of rendered dynamic pages.
+    Entries live in a size-bounded in-memory LRU, optionally backed by a disk tier.
+    Each entry is a dict with body, status, headers, identity (source file mtime/size) and expires.
+    """
+
+    def __init__(self, max_bytes, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._revalidating = set()
+        self._lock = threading.Lock()
+        if disk_dir and not os.path.exists(disk_dir):
+            os.makedirs(disk_dir)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.cache')
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if entry.get('key') != key:
+            return None
+        self._store(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        entry['key'] = key
+        self._store(key, entry)
+        if self.disk_dir:
+            try:
+                tmp_path = self._disk_path(key) + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(entry, f)
+                os.replace(tmp_path, self._disk_path(key))
+            except OSError as e:
+                app.logger.error(f"Response cache write failed: {str(e)}")
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key)['body'])
+        if self.disk_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def _store(self, key, entry):
+        size = len(entry['body'])
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key)['body'])
+            if size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= len(self._entries.popitem(last=False)[1]['body'])
+
+    def start_revalidation(self, key):
+        """Return True if the caller should re-render key (no other revalidation is running)"""
+        with self._lock:
+            if key in self._revalidating:
+                return False
+            self._revalidating.add(key)
+            return True
+
+    def end_revalidation(self, key):
+        with self._lock:
+            self._revalidating.discard(key)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+            'hits': self.hits, 'stale_hits': self.stale_hits, 'misses': self.misses
+        }
+
+
+response_cache = ResponseCache(Config.RESPONSE_CACHE_SIZE, Config.RESPONSE_CACHE_DIR)
+
+
+def response_cache_ttl(url_path):
+    """Return the cache TTL configured for a URL path, or None if it is not cached"""
+    for pattern, ttl in Config.RESPONSE_CACHE_RULES.items():
+        if fnmatch.fnmatchcase(url_path, pattern):
+            return ttl
+    return None
+
+
+def response_cache_key():
+    vary = tuple(request.headers.get(name, '') for name in Config.RESPONSE_CACHE_VARY)
+    return request.method, request.host, request.path, request.query_string, vary
+
+
+def render_dynamic(fs_path, ext, stream=True):
+    """Render a .pys, .php or .pp file"""
+    if ext == 'pys':
+        return render_pys(fs_path, stream)
+    if ext == 'php':
+        if Config.PHP_STREAMING:
+            return php_response(fs_path, stream)
+        return run_php(fs_path)[1]
+    return run_pp(fs_path, stream)
+
+
+def _render_cache_entry(fs_path, ext, ttl, identity):
+    response = app.make_response(render_dynamic(fs_path, ext, stream=False))
+    entry = None
+    # Pages that set cookies or forbid shared caching (e.g. PHP sessions) are never stored
+    if response.status_code == 200 and is_shareable(response.headers.items()):
+        entry = {
+            'body': response.get_data(),
+            'status': response.status_code,
+            'headers': list(response.headers.items()),
+            'identity': identity,
+            'expires': time.time() + ttl
+        }
+    return response, entry
+
+
+def _cached_response(entry, state):
+    response = Response(entry['body'], status=entry['status'], headers=entry['headers'])
+    response.headers['X-Cache'] = state
+    return response
+
+
+def serve_dynamic(fs_path, ext):
+    """
+    Serve a dynamic page, going through the response cache when a
+    RESPONSE_CACHE_RULES entry matches the request path.
+    """
+    ttl = response_cache_ttl(request.path)
+    if ttl is None or request.method not in ('GET', 'HEAD'):
+        return render_dynamic(fs_path, ext)
+
+    st = os.stat(fs_path)
+    identity = (st.st_mtime_ns, st.st_size)
+    key = response_cache_key()
+    entry = response_cache.get(key)
+    if entry is not None and entry['identity'] != identity:
+        response_cache.discard(key)
+        entry = None
+    if entry is not None:
+        now = time.time()
+        if now < entry['expires']:
+            response_cache.hits += 1
+            return _cached_response(entry, 'HIT')
+        if now < entry['expires'] + Config.RESPONSE_CACHE_STALE:
+            response_cache.stale_hits += 1
+            if response_cache.start_revalidation(key):
+                @copy_current_request_context
+                def revalidate():
+                    try:
+                        new_entry = _render_cache_entry(fs_path, ext, ttl, identity)[1]
+                        if new_entry is not None:
+                            response_cache.set(key, new_entry)
+                    except Exception as e:
+                        app.logger.error(f"Response cache revalidation failed: {str(e)}")
+                    finally:
+                        response_cache.end_revalidation(key)
+                threading.Thread(target=revalidate, daemon=True).start()
+            return _cached_response(entry, 'STALE')
+
+    response_cache.misses += 1
+    response, entry = _render_cache_entry(fs_path, ext, ttl, identity)
+    if entry is not None:
+        response_cache.set(key, entry)
+    response.headers['X-Cache'] = 'MISS'
+    return response
+
+# ================
+# Static Files
+# ================
+
+def parse_range_header(value, size):
+    """
+    Parse a Range header for a file of size bytes.
+    Returns a list of (start, end) ranges (end exclusive), [] when no range is
+    satisfiable, or None when the header is malformed or should be ignored.
+    """
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        if not dash or not (first or last) or not (first.isdigit() or not first) or not (last.isdigit() or not last):
+            return None
+        if not first:
+            length = int(last)
+            if length:
+                ranges.append((max(0, size - length), size))
+            continue
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+        if last and int(last) < start:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    # Too many or overlapping ranges would multiply the response size, send the whole file instead
+    if len(ranges) > Config.MAX_RANGES or sum(end - start for start, end in ranges) > size:
+        return None
+    return ranges
+
+
+_content_hashes = OrderedDict()
+_content_hashes_lock = threading.Lock()
+
+
+def content_hash(path, st, content=None):
+    """SHA-1 of a file's content, computed once per (path, inode, size, mtime)"""
+    key = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+    with _content_hashes_lock:
+        digest = _content_hashes.get(key)
+        if digest is not None:
+            _content_hashes.move_to_end(key)
+            return digest
+    hasher = hashlib.sha1()
+    for chunk in (content,) if content is not None else read_file_range(path, 0, st.st_size):
+        hasher.update(chunk)
+    digest = hasher.hexdigest()
+    with _content_hashes_lock:
+        _content_hashes[key] = digest
+        while len(_content_hashes) > Config.ETAG_HASH_CACHE_SIZE:
+            _content_hashes.popitem(last=False)
+    return digest
+
+
+def file_etag(path, st, content=None):
+    """
+    ETag of a static file according to Config.ETAG: 'strong' and 'weak' are
+    derived from inode, size and mtime, 'hash' from the content. None disables ETags.
+    """
+    if Config.ETAG == 'hash':
+        return f'"{content_hash(path, st, content)}"'
+    if Config.ETAG in ('strong', 'weak'):
+        etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+        return 'W/' + etag if Config.ETAG == 'weak' else etag
+    return None
+
+
+def _opaque_tag(etag):
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def not_modified(st, etag):
+    """Check the If-None-Match / If-Modified-Since headers of a GET or HEAD request against a file"""
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since and uses the weak comparison
+        if if_none_match.strip() == '*':
+            return True
+        return etag is not None and _opaque_tag(etag) in [_opaque_tag(tag) for tag in if_none_match.split(',')]
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if not if_modified_since:
+        return False
+    try:
+        return int(st.st_mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def set_validators(response, st, etag):
+    """Add the ETag and Last-Modified headers of a static file to a response"""
+    if etag is not None:
+        response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = email.utils.formatdate(st.st_mtime, usegmt=True)
+    return response
+
+
+def not_modified_response(st, etag):
+    """304 Not Modified response carrying the file's validators"""
+    response = Response(status=304)
+    del response.headers['Content-Type']
+    return set_validators(response, st, etag)
+
+
+_ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def compressible(content_type):
+    """Check whether a content type is worth compressing (Config.COMPRESS_TYPES)"""
+    return any(fnmatch.fnmatchcase(content_type, pattern) for pattern in Config.COMPRESS_TYPES)
+
+
+def accepted_encodings():
+    """Content codings accepted by the client according to its Accept-Encoding header"""
+    accepted = set()
+    rejected = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            (accepted if q > 0 else rejected).add(coding)
+    if '*' in accepted:
+        accepted.update(coding for coding in _ENCODING_SUFFIXES if coding not in rejected)
+    return accepted
+
+
+def compress(content, encoding, best=False):
+    """Compress bytes with 'br' or 'gzip', best=True uses the maximum level (for --precompress)"""
+    if encoding == 'br':
+        return brotli.compress(content, quality=11 if best else Config.BROTLI_QUALITY)
+    return gzip.compress(content, compresslevel=9 if best else Config.COMPRESS_LEVEL, mtime=0)
+
+
+def encoded_variant(path, st, content, etag):
+    """
+    Compressed representation of a static file for the request's Accept-Encoding.
+    An up-to-date .br/.gz sibling is preferred, otherwise the content is compressed
+    on the fly and kept in compressed_cache, keyed by the file's identity.
+    Returns (encoding, body, etag), or None when the file is sent as it is.
+    """
+    accepted = accepted_encodings()
+    if Config.PRECOMPRESSED:
+        for encoding, suffix in _ENCODING_SUFFIXES.items():
+            if encoding not in accepted:
+                continue
+            found = static_cache.sibling(path, suffix, st)
+            if found is None:
+                continue
+            body, sibling_st = found
+            if sibling_st.st_mtime_ns >= st.st_mtime_ns:
+                return encoding, body, file_etag(path + suffix, sibling_st, body)
+
+    if not Config.COMPRESS or not Config.COMPRESS_MIN_SIZE <= len(content) <= Config.COMPRESS_MAX_SIZE:
+        return None
+    for encoding in _ENCODING_SUFFIXES:
+        if encoding not in accepted or (encoding == 'br' and brotli is None):
+            continue
+        key = ('compressed', encoding, path, st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = compressed_cache.get(key)
+        if cached is not None:
+            body = cached[0]
+        else:
+            body = compress(content, encoding)
+            compressed_cache.set(key, body)
+        if len(body) >= len(content):
+            return None
+        return encoding, body, etag and f'{etag[:-1]}-{encoding}"'
+    return None
+
+
+_STATIC_CATEGORIES = (
+    ('html', 'HTML_EXTENSIONS'), ('image', 'IMAGE_EXTENSIONS'), ('video', 'VIDEO_EXTENSIONS'),
+    ('audio', 'AUDIO_EXTENSIONS'), ('font', 'FONT_EXTENSIONS'), ('download', 'DOWNLOAD_EXTENSIONS')
+)
+
+
+def static_category(path):
+    """Category of a static file as in serve(): html, image, video, audio, font, download or other"""
+    ext = get_file_extension(path)
+    for category, option in _STATIC_CATEGORIES:
+        if ext in getattr(Config, option):
+            return category
+    return 'other'
+
+
+def cache_control(path):
+    """
+    Cache-Control policy of a static file, or None. Path globs win over
+    fingerprinted file names, which win over categories; the rules of the
+    request's host (CACHE_CONTROL_HOSTS) come before CACHE_CONTROL at each step.
+    """
+    rule_sets = [rules for rules in (Config.CACHE_CONTROL_HOSTS.get(str(request.host)), Config.CACHE_CONTROL) if rules]
+    for rules in rule_sets:
+        for pattern, value in rules.items():
+            if pattern.startswith('/') and fnmatch.fnmatchcase(request.path, pattern):
+                return value
+    if Config.CACHE_FINGERPRINT_PATTERN and re.search(Config.CACHE_FINGERPRINT_PATTERN, os.path.basename(path)):
+        return Config.CACHE_CONTROL_FINGERPRINTED
+    category = static_category(path)
+    for rules in rule_sets:
+        if category in rules:
+            return rules[category]
+    return None
+
+
+def set_cache_policy(response, path):
+    """Add the Cache-Control (and Expires) headers of a static file to a response"""
+    value = cache_control(path)
+    if not value:
+        return response
+    response.headers['Cache-Control'] = value
+    max_age = re.search(r'(?:^|[,\s])max-age=(\d+)', value)
+    if Config.CACHE_EXPIRES and max_age:
+        response.headers['Expires'] = email.utils.formatdate(time.time() + int(max_age.group(1)), usegmt=True)
+    return response
+
+
+def if_range_matches(st, etag):
+    """Check an If-Range precondition against a file's stat result and ETag"""
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    if value.startswith(('"', 'W/')):
+        # Only a strong ETag can validate a range
+        return etag is not None and not etag.startswith('W/') and value.strip() == etag
+    try:
+        return int(email.utils.parsedate_to_datetime(value).timestamp()) == int(st.st_mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+def requested_ranges(st, size, etag):
+    """Byte ranges requested for a static file: None for the whole file, [] when unsatisfiable"""
+    if request.method != 'GET' or 'Range' not in request.headers or not if_range_matches(st, etag):
+        return None
+    return parse_range_header(request.headers['Range'], size)
+
+
+def read_file_range(path, start, end):
+    """Yield the bytes [start, end) of a file in CHUNK_SIZE blocks"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(Config.CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_body(path, start, end, size, file_wrapper=None):
+    """
+    Response body for the bytes [start, end) of a file. When the WSGI server
+    offers wsgi.file_wrapper (gunicorn, uWSGI, waitress...) and the span runs to
+    the end of the file, the open file is handed to the server, which can send
+    it with sendfile() without copying it through Python. Otherwise a generator
+    reads it in CHUNK_SIZE blocks. file_wrapper is looked up by the caller, and
+    only for a body that is the whole response: nested in a multipart body the
+    wrapped file would be neither sent with sendfile() nor closed.
+    """
+    if Config.SENDFILE and file_wrapper is not None and end == size:
+        f = open(path, 'rb')
+        f.seek(start)
+        return file_wrapper(f, Config.CHUNK_SIZE)
+    return read_file_range(path, start, end)
+
+
+def range_response(ranges, size, content_type, read):
+    """
+    Build a 206 Partial Content response, a single part or multipart/byteranges.
+    read(start, end) returns an iterable over the bytes [start, end) of the file.
+    """
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = Response(read(start, end), status=206, content_type=content_type, direct_passthrough=True)
+        response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        response.headers['Content-Length'] = end - start
+        return response
+
+    boundary = os.urandom(12).hex()
+    parts = [
+        (f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+         f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n').encode('latin-1')
+        for start, end in ranges
+    ]
+    closing = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+
+    def generate():
+        for index, (start, end) in enumerate(ranges):
+            yield (b'\r\n' if index else b'') + parts[index]
+            yield from read(start, end)
+        yield closing
+
+    response = Response(generate(), status=206, content_type=f'multipart/byteranges; boundary={boundary}',
+                        direct_passthrough=True)
+    response.headers['Content-Length'] = (
+        sum(len(part) for part in parts) + 2 * (len(parts) - 1)
+        + sum(end - start for start, end in ranges) + len(closing)
+    )
+    return response
+
+
+def range_not_satisfiable(size, error_page):
+    """416 response for a Range header that no part of the file satisfies"""
+    response = make_response(error_page)
+    response.headers['Content-Range'] = f'bytes */{size}'
+    return response
+
+
+STATIC_CACHE_MISSING_SIZE = 4096  # missing .br/.gz siblings remembered by StaticFileCache
+
+
+class StaticFileCache:
+    """
+    In-memory LRU of small static files with a byte budget.
+    Entries are revalidated against the file's inode/size/mtime at most once
+    per STATIC_CACHE_REVALIDATE seconds, so hot assets are served without opening the file.
+    """
+
+    def __init__(self, max_bytes, max_file_size, revalidate):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate = revalidate
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # path -> [content, stat result, last checked]
+        self._missing = OrderedDict()  # (path, sibling suffix, identity of path) -> last checked
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _identity(st):
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def get(self, path):
+        """Return (content, stat result) of a fresh entry or None"""
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if not self.revalidate or now - entry[2] >= self.revalidate:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is None or self._identity(st) != self._identity(entry[1]):
+                with self._lock:
+                    if self._entries.get(path) is entry:
+                        self._remove(path)
+                return None
+            entry[2] = now
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+            self.hits += 1
+        return entry[0], entry[1]
+
+    def load(self, path):
+        """Return (content, stat result) from memory or read the file, raises OSError"""
+        cached = self.get(path)
+        if cached is not None:
+            return cached
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            content = f.read()
+        with self._lock:
+            self.misses += 1
+        self.set(path, content, st)
+        return content, st
+
+    def sibling(self, path, suffix, st):
+        """
+        load() for the file path + suffix (e.g. a precompressed .gz), None when it does not exist.
+        A missing sibling is remembered for the version st of path, whether or not path itself
+        is cached, and looked for again after STATIC_CACHE_REVALIDATE seconds.
+        """
+        key = (path, suffix, self._identity(st))
+        now = time.monotonic()
+        with self._lock:
+            checked = self._missing.get(key)
+        if checked is not None and self.revalidate and now - checked < self.revalidate:
+            return None
+        try:
+            found = self.load(path + suffix)
+        except OSError:
+            found = None
+        with self._lock:
+            if found is not None:
+                self._missing.pop(key, None)
+            else:
+                self._missing[key] = now
+                self._missing.move_to_end(key)
+                if len(self._missing) > STATIC_CACHE_MISSING_SIZE:
+                    self._missing.popitem(last=False)
+        return found
+
+    def set(self, path, content, st):
+        size = len(content)
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+            if size > self.max_file_size or size > self.max_bytes:
+                return
+            self._entries[path] = [content, st, time.monotonic()]
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._missing.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions
+        }
+
+    def _remove(self, path):
+        self.size -= len(self._entries.pop(path)[0])
+
+
+static_cache = StaticFileCache(Config.STATIC_CACHE_SIZE, Config.STATIC_CACHE_MAX_FILE_SIZE,
+                               Config.STATIC_CACHE_REVALIDATE)
+compressed_cache = FragmentCache(Config.COMPRESS_CACHE_SIZE)
+
+
+def precompress_www():
+    """
+    Write .gz siblings (and .br siblings when brotli is installed) of every
+    compressible static file under the document roots, at the maximum
+    compression level. Siblings that are newer than their file are kept.
+    Returns the process exit code.
+    """
+    encodings = [encoding for encoding in _ENCODING_SUFFIXES if encoding != 'br' or brotli is not None]
+    written = 0
+    errors = 0
+    for root in document_roots():
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names.sort()
+            for name in sorted(file_names):
+                ext = get_file_extension(name)
+                content_type = 'text/html' if ext in ('html', 'htm') else Config.MIME_TYPES.get(ext)
+                if not content_type or not compressible(content_type):
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    st = os.stat(path)
+                    if st.st_size < Config.COMPRESS_MIN_SIZE:
+                        continue
+                    content = None
+                    for encoding in encodings:
+                        target = path + _ENCODING_SUFFIXES[encoding]
+                        if os.path.exists(target) and os.stat(target).st_mtime_ns >= st.st_mtime_ns:
+                            continue
+                        if content is None:
+                            with open(path, 'rb') as f:
+                                content = f.read()
+                        body = compress(content, encoding, best=True)
+                        if len(body) >= len(content):
+                            continue
+                        with open(target + '.tmp', 'wb') as f:
+                            f.write(body)
+                        os.replace(target + '.tmp', target)
+                        written += 1
+                except OSError as e:
+                    print(colorama.Fore.RED + f'{path}: {str(e)}')
+                    errors += 1
+    if brotli is None:
+        print(colorama.Fore.YELLOW + 'brotli is not installed, only .gz files were written')
+    color = colorama.Fore.RED if errors else colorama.Fore.GREEN
+    print(color + f'Precompressed {written} file(s), {errors} error(s)' + colorama.Fore.RESET)
+    return 1 if errors else 0
+
+
+# ================
+# Path Resolution
+# ================
+
+def resolve_path(fs_path):
+    """
+    What serve() finds at a file system path, as (kind, target, directory):
+    ('index', index file, fs_path), ('directory', fs_path, fs_path),
+    ('file', fs_path, parent) or ('missing', fs_path, nearest existing ancestor).
+    directory is the one whose changes can alter the result, normalized so
+    that 'site/' and 'site' are the same directory.
+    """
+    if os.path.isdir(fs_path):
+        directory = os.path.normpath(fs_path)
+        for index_file in Config.HTML_EXTENSIONS:
+            index_path = os.path.join(fs_path, 'index.' + index_file)
+            if os.path.exists(index_path):
+                return 'index', index_path, directory
+        return 'directory', fs_path, directory
+    parent = os.path.normpath(os.path.dirname(fs_path))
+    if os.path.isfile(fs_path):
+        return 'file', fs_path, parent
+    while not os.path.isdir(parent):
+        if os.path.dirname(parent) in (parent, ''):
+            parent = os.path.dirname(parent) or '.'
+            break
+        parent = os.path.dirname(parent)
+    return 'missing', fs_path, parent
+
+
+class InotifyWatcher:
+    """Reports changes of watched directories through Linux inotify (via ctypes)"""
+
+    kind = 'inotify'
+    # IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    MASK = 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, callback):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.callback = callback
+        self._directories = {}  # watch descriptor -> directories (one descriptor per inode)
+        self._watched = set()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def watch(self, directory):
+        """Start watching a directory, returns False when no watch could be added"""
+        if directory in self._watched:
+            return True
+        wd = self._add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            return False
+        with self._lock:
+            self._directories.setdefault(wd, set()).add(directory)
+            self._watched.add(directory)
+        return True
+
+    def _loop(self):
+        while True:
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset + self.EVENT.size <= len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    # Events were lost, forget everything
+                    self.callback(None)
+                    continue
+                with self._lock:
+                    directories = set(self._directories.get(wd, ()))
+                    if mask & self.IN_IGNORED:
+                        self._directories.pop(wd, None)
+                        self._watched.difference_update(directories)
+                for directory in directories:
+                    self.callback(directory)
+
+
+class PollingWatcher:
+    """Reports changes of watched directories by comparing their mtime every interval seconds"""
+
+    kind = 'polling'
+
+    def __init__(self, callback, interval):
+        self.callback = callback
+        self.interval = interval
+        self._mtimes = {}  # directory -> st_mtime_ns
+        self._lock = threading.Lock()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def watch(self, directory):
+        if directory in self._mtimes:
+            return True
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return False
+        with self._lock:
+            self._mtimes[directory] = mtime
+        return True
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                watched = list(self._mtimes.items())
+            for directory, mtime in watched:
+                try:
+                    current = os.stat(directory).st_mtime_ns
+                except OSError:
+                    current = None
+                if current == mtime:
+                    continue
+                with self._lock:
+                    if current is None:
+                        self._mtimes.pop(directory, None)
+                    else:
+                        self._mtimes[directory] = current
+                self.callback(directory)
+
+
+def start_directory_watcher(callback):
+    """Watcher for PathCache: inotify on Linux, directory polling elsewhere, None when disabled"""
+    if not Config.PATH_CACHE_WATCH:
+        return None
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(callback)
+        except (OSError, AttributeError) as e:
+            app.logger.warning(f"inotify unavailable, polling directories instead: {str(e)}")
+    if Config.PATH_CACHE_POLL_INTERVAL:
+        return PollingWatcher(callback, Config.PATH_CACHE_POLL_INTERVAL)
+    return None
+
+
+class PathCache:
+    """
+    LRU of resolve_path() results keyed by file system path, including misses.
+    Entries live at most PATH_CACHE_TTL seconds and are dropped as soon as the
+    directory they depend on is reported as changed by the directory watcher.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # fs path -> (kind, target, directory, expires)
+        self._dependents = {}  # directory -> fs paths whose entry depends on it
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    def resolve(self, fs_path):
+        """Return (kind, target) for fs_path, see resolve_path()"""
+        if not self.max_entries:
+            return resolve_path(fs_path)[:2]
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(fs_path)
+            if entry is not None and entry[3] > now:
+                self._entries.move_to_end(fs_path)
+                self.hits += 1
+                return entry[0], entry[1]
+            self.misses += 1
+
+        kind, target, directory = resolve_path(fs_path)
+        watcher = self._get_watcher()
+        if watcher is not None:
+            watcher.watch(directory)
+        with self._lock:
+            if fs_path in self._entries:
+                self._remove(fs_path)
+            self._entries[fs_path] = (kind, target, directory, now + self.ttl)
+            self._dependents.setdefault(directory, set()).add(fs_path)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+        return kind, target
+
+    def invalidate(self, directory):
+        """Drop the entries that depend on a directory (all entries for None)"""
+        with self._lock:
+            if directory is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._dependents.clear()
+                return
+            for fs_path in self._dependents.pop(directory, ()):
+                self._entries.pop(fs_path, None)
+                self.invalidations += 1
+
+    def clear(self):
+        self.invalidate(None)
+
+    def stats(self):
+        with self._lock:
+            missing = sum(1 for entry in self._entries.values() if entry[0] == 'missing')
+        return {
+            'entries': len(self._entries), 'missing': missing, 'max_entries': self.max_entries,
+            'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+            'watcher': self._watcher.kind if self._watcher else None
+        }
+
+    def _get_watcher(self):
+        if self._watcher is None:
+            with self._lock:
+                if self._watcher is None:
+                    self._watcher = start_directory_watcher(self.invalidate) or False
+        return self._watcher or None
+
+    def _remove(self, fs_path):
+        directory = self._entries.pop(fs_path)[2]
+        dependents = self._dependents.get(directory)
+        if dependents is not None:
+            dependents.discard(fs_path)
+            if not dependents:
+                del self._dependents[directory]
+
+
+path_cache = PathCache(Config.PATH_CACHE_SIZE, Config.PATH_CACHE_TTL)
+
 
 # ================
 # Helper Functions
@@ -498,16 +3303,41 @@ def is_allowed_file(path, extensions):
     return os.path.isfile(path) and ext in extensions
 
 
-def serve_file(path, content_type, as_attachment=False):
-    """Serve file with proper Content-Type header"""
+def serve_file(path, content_type, as_attachment=False, cached=None):
+    """Serve file with proper Content-Type header, cached is a static_cache entry already looked up"""
     try:
-        with open(path, 'rb') as f:
-            content = f.read()
+        content, st = cached or static_cache.load(path)
     except IOError:
         return serve_error_page(404)
 
-    response = make_response(content)
-    response.headers['Content-Type'] = content_type
+    etag = file_etag(path, st, content)
+    vary = (Config.COMPRESS or Config.PRECOMPRESSED) and compressible(content_type)
+    encoding = None
+    # Compressed responses are never ranged, a Range request gets the file as it is
+    if vary and 'Range' not in request.headers:
+        variant = encoded_variant(path, st, content, etag)
+        if variant is not None:
+            encoding, content, etag = variant
+    if not_modified(st, etag):
+        response = not_modified_response(st, etag)
+        if vary:
+            response.headers['Vary'] = 'Accept-Encoding'
+        return set_cache_policy(response, path)
+    ranges = requested_ranges(st, len(content), etag)
+    if ranges == []:
+        return range_not_satisfiable(len(content), serve_error_page(416))
+    if ranges:
+        response = range_response(ranges, len(content), content_type, lambda start, end: (content[start:end],))
+    else:
+        response = make_response(content)
+        response.headers['Content-Type'] = content_type
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+    response.headers['Accept-Ranges'] = 'bytes'
+    if vary:
+        response.headers['Vary'] = 'Accept-Encoding'
+    set_validators(response, st, etag)
+    set_cache_policy(response, path)
     if as_attachment:
         filename = os.path.basename(path)
         response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
@@ -517,32 +3347,44 @@ def serve_file(path, content_type, as_attachment=False):
 def serve_large_file(path, content_type, as_attachment=False):
     """Serve large files using streaming to avoid memory issues"""
     try:
+        # Hot small files are answered from memory without a stat() here
+        cached = static_cache.get(path)
+        if cached is not None:
+            return serve_file(path, content_type, as_attachment, cached)
+
         # Get file size for Content-Length header
-        file_size = os.path.getsize(path)
+        st = os.stat(path)
+        file_size = st.st_size
         
         # Check if we should use streaming based on file size
         if file_size < Config.LARGE_FILE_THRESHOLD:
             # For smaller files, use the regular function
             return serve_file(path, content_type, as_attachment)
         
-        # For large files, use streaming
-        def generate():
-            with open(path, 'rb') as f:
-                while True:
-                    chunk = f.read(Config.CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    yield chunk
-        
-        response = Response(
-            generate(),
-            mimetype=content_type,
-            direct_passthrough=True
-        )
+        etag = file_etag(path, st)
+        if not_modified(st, etag):
+            return set_cache_policy(not_modified_response(st, etag), path)
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        ranges = requested_ranges(st, file_size, etag)
+        if ranges == []:
+            return range_not_satisfiable(file_size, serve_error_page(416))
+        if ranges:
+            part_wrapper = file_wrapper if len(ranges) == 1 else None
+            response = range_response(ranges, file_size, content_type,
+                                      lambda start, end: file_body(path, start, end, file_size, part_wrapper))
+        else:
+            # For large files, use streaming (or the server's zero-copy file wrapper)
+            response = Response(
+                file_body(path, 0, file_size, file_size, file_wrapper),
+                mimetype=content_type,
+                direct_passthrough=True
+            )
+            response.headers['Content-Length'] = file_size
         
         # Set headers
-        response.headers['Content-Length'] = file_size
         response.headers['Accept-Ranges'] = 'bytes'
+        set_validators(response, st, etag)
+        set_cache_policy(response, path)
         
         if as_attachment:
             filename = os.path.basename(path)
@@ -666,42 +3508,66 @@ def before_request():
     log_request()
 
 
+@app.after_request
+def after_request(response):
+    """Add the Server-Timing header to rendered pages"""
+    timings = request.environ.get('pyserve.timings')
+    if Config.SERVER_TIMING and timings and not response.is_streamed:
+        response.headers['Server-Timing'] = server_timing_header(timings)
+    return response
+
+
+def admin_stats():
+    """Statistics page for dynamic pages and caches"""
+    if request.remote_addr not in Config.ADMIN_ALLOWED_IPS:
+        abort(403)
+    if request.args.get('format') == 'json':
+        pages, blocks = page_stats.snapshot()
+        return jsonify({
+            'pages': pages,
+            'blocks': [dict(stats, page=page, block=block) for (page, block), stats in blocks.items()],
+            'fragment_cache': fragment_cache.stats(),
+            'response_cache': response_cache.stats(),
+            'static_cache': static_cache.stats(),
+            'compressed_cache': compressed_cache.stats(),
+            'path_cache': path_cache.stats(),
+            'render_workers': _render_pool.stats() if _render_pool is not None else None,
+            'php_fastcgi_workers': _fastcgi_pool.stats() if _fastcgi_pool is not None else None,
+            'php_admission': php_admission.stats()
+        })
+    return generate_stats_page()
+
+
+if Config.ADMIN_PATH:
+    app.add_url_rule(Config.ADMIN_PATH, 'admin_stats', admin_stats)
+
+
 @app.route('/', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'])
 @app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'])
 def serve(path):
     """Main request handler"""
     Config.WWW_ROOT = Config.WWW_ROOT.replace('/','\\')
+    request.environ['pyserve.document_root'] = Config.WWW_ROOT
     fs_path = os.path.join(Config.WWW_ROOT, path)
-    if os.path.isdir(fs_path):
-        # Check for index files
-        for index_file in Config.HTML_EXTENSIONS:
-            index_path = os.path.join(fs_path, 'index.'+index_file)
-            if os.path.exists(index_path):
-                if index_file == 'pys':
-                    with open(index_path, 'r', encoding=Config.ENCODING) as f:
-                        html_content = f.read()
-                    return extract_all_python_tags(html_content)
-                if index_file == 'php':
-                    return run_php(index_path)[1]
-                if index_file == 'pp':
-                    return run_pp(index_path)
-                return serve_file(index_path, 'text/html')
+    kind, target = path_cache.resolve(fs_path)
+    if kind == 'index':
+        # Index file of a directory
+        index_file = get_file_extension(target)
+        if index_file in ('pys', 'php', 'pp'):
+            return serve_dynamic(target, index_file)
+        return serve_file(target, 'text/html')
+
+    elif kind == 'directory':
         # Generate directory listing if no index file found
         return generate_directory_listing(fs_path, '/' + path)
 
     # Handle file requests
-    if os.path.isfile(fs_path):
+    elif kind == 'file':
         ext = get_file_extension(fs_path).lower()
         # HTML files
         if ext in Config.HTML_EXTENSIONS:
-            if ext == 'pys':
-                with open(fs_path, 'r', encoding=Config.ENCODING) as f:
-                    html_content = f.read()
-                return extract_all_python_tags(html_content)
-            if ext == 'php':
-                return run_php(fs_path)[1]
-            if ext == 'pp':
-                return run_pp(fs_path)
+            if ext in ('pys', 'php', 'pp'):
+                return serve_dynamic(fs_path, ext)
             return serve_file(fs_path, 'text/html')
 
         # Images
@@ -746,6 +3612,16 @@ for code in [400, 401, 403, 404, 405, 406, 408, 409, 410,
 # ================
 
 if __name__ == "__main__":
+    if PRECOMPILE or PRECOMPRESS:
+        sys.exit(max(precompile_www() if PRECOMPILE else 0, precompress_www() if PRECOMPRESS else 0))
+    get_base_namespace()
+    load_bytecode_cache()
+    if Config.PYS_WORKER_PROCESSES:
+        get_render_pool()
+    for root in document_roots():
+        php_env_template(root)
+    if Config.PHP_FASTCGI:
+        get_fastcgi_pool()
     print(f"Starting server on port {Config.PORT}")
     app.run(host='0.0.0.0', port=Config.PORT)
 
@@ -0,0 +1,85 @@
+"""
+Microbenchmark of the <python> tag scanners.
+
+Times extract_python_tags() against the per-character scanner it replaced
+(tests/legacy_scanner.py) on a large, mostly static page, and PPTokenizer
+fed the same page as bytes in 8 KiB chunks.
+
+Usage:  python bench/bench_scanner.py [PyServe|DinoWebServe] [size_kb]
+"""
+import importlib
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from legacy_scanner import extract_python_tags as legacy_extract_python_tags
+
+CHUNK_SIZE = 8192
+
+
+def build_page(size):
+    """A page of about `size` characters: markup, a script, a style sheet, comments and a few <python> blocks"""
+    block = (
+        '<div class="item"><h2>Title</h2><p>Some static text with <a href="/x?a=1&b=2">a link</a>, '
+        '"quotes" and \'apostrophes\'.</p></div>\n'
+        '<!-- a comment with <b>markup</b> -->\n'
+    )
+    head = (
+        '<html><head><style>p::after { content: "</style>"; }</style>\n'
+        '<script>var s = "</script>"; function f() { return `x`; }</script></head><body>\n'
+    )
+    body = []
+    length = len(head)
+    count = 0
+    while length < size:
+        body.append(block)
+        length += len(block)
+        count += 1
+        if count % 500 == 0:
+            body.append('<python>echo(%d)</python>\n' % count)
+    return head + ''.join(body) + '</body></html>\n'
+
+
+def best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else 'PyServe'
+    size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 830 * 1024
+    # The servers read their config directory from the command line when imported
+    sys.argv = [sys.argv[0], os.path.join(ROOT, 'config')]
+    server = importlib.import_module(name)
+
+    page = build_page(size)
+    data = page.encode('utf-8')
+    assert server.extract_python_tags(page) == legacy_extract_python_tags(page)
+
+    def tokenize():
+        tokenizer = server.PPTokenizer()
+        for pos in range(0, len(data), CHUNK_SIZE):
+            tokenizer.feed(data[pos:pos + CHUNK_SIZE])
+        tokenizer.close()
+
+    print(f'{name}: {len(page) / 1024:.0f} KB page')
+    legacy = best_of(lambda: legacy_extract_python_tags(page), 3)
+    current = best_of(lambda: server.extract_python_tags(page), 20)
+    streamed = best_of(tokenize, 20)
+    print(f'  legacy scanner       {legacy * 1000:9.1f} ms')
+    print(f'  extract_python_tags  {current * 1000:9.1f} ms  ({legacy / current:.0f}x)')
+    print(f'  PPTokenizer (8 KiB)  {streamed * 1000:9.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
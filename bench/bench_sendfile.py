@@ -0,0 +1,127 @@
+"""
+Throughput and CPU cost of serving a large static file, with and without Config.SENDFILE.
+
+Starts gunicorn (1 sync worker) on a scratch document root holding one large
+file, downloads it several times and reports the transfer rate and the CPU
+time the worker spent per GB sent. Also checks that an open-ended range
+(sent through wsgi.file_wrapper) and a bounded range (sent by the generator)
+have the expected lengths.
+
+Usage:  python bench/bench_sendfile.py [PyServe|DinoWebServe] [size_mb] [repeat]
+Needs gunicorn (pip install gunicorn).
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+PORT = 8765
+FILE_NAME = 'big.bin'
+CPU_PATH = '/__bench_cpu'
+
+
+def make_app():
+    """WSGI app run by gunicorn: the server under test, plus CPU_PATH reporting the worker's CPU time"""
+    sys.argv = [sys.argv[0], os.path.join(ROOT, 'config')]
+    sys.path.insert(0, ROOT)
+    server = __import__(os.environ['BENCH_SERVER'])
+    # serve() rewrites '/' in the document root, so it is given relative to the working directory
+    server.Config.WWW_ROOT = 'www'
+    server.Config.LOG_DIR = 'log'
+    server.Config.SENDFILE = os.environ['BENCH_SENDFILE'] == '1'
+    inner = server.app.wsgi_app
+
+    def app(environ, start_response):
+        if environ.get('PATH_INFO') == CPU_PATH:
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [repr(time.process_time()).encode()]
+        return inner(environ, start_response)
+
+    server.app.wsgi_app = app
+    return server.app
+
+
+def fetch(path, headers=None):
+    """Download path and return the number of body bytes"""
+    request = urllib.request.Request(f'http://127.0.0.1:{PORT}{path}', headers=headers or {})
+    total = 0
+    with urllib.request.urlopen(request) as response:
+        while True:
+            chunk = response.read(1 << 20)
+            if not chunk:
+                return total
+            total += len(chunk)
+
+
+def worker_cpu():
+    with urllib.request.urlopen(f'http://127.0.0.1:{PORT}{CPU_PATH}') as response:
+        return float(response.read())
+
+
+def wait_until_up(process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited, see gunicorn.log in the scratch directory')
+        try:
+            worker_cpu()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not start')
+
+
+def run(workdir, server, sendfile, size, repeat):
+    env = dict(os.environ, BENCH_SERVER=server, BENCH_SENDFILE='1' if sendfile else '0')
+    with open(os.path.join(workdir, 'gunicorn.log'), 'ab') as log:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-w', '1', '-b', f'127.0.0.1:{PORT}',
+             '--chdir', workdir, '--pythonpath', BENCH_DIR, 'bench_sendfile:make_app()'],
+            env=env, stdout=log, stderr=log)
+    try:
+        wait_until_up(process)
+        fetch('/' + FILE_NAME)  # warm the page cache
+        cpu = worker_cpu()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            assert fetch('/' + FILE_NAME) == size
+        elapsed = time.perf_counter() - start
+        cpu = worker_cpu() - cpu
+        gb = size * repeat / 1e9
+        tail = fetch('/' + FILE_NAME, {'Range': f'bytes={size - 20}-'})
+        middle = fetch('/' + FILE_NAME, {'Range': 'bytes=10-19'})
+        assert tail == 20, f'open-ended range returned {tail} bytes'
+        assert middle == 10, f'bounded range returned {middle} bytes'
+        print(f'  SENDFILE={str(sendfile):5}  {gb / elapsed:6.2f} GB/s  {cpu / gb:6.3f} CPU s/GB'
+              f'  (ranges: {tail} and {middle} bytes)')
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    server = sys.argv[1] if len(sys.argv) > 1 else 'PyServe'
+    size = int(sys.argv[2]) * 1024 * 1024 if len(sys.argv) > 2 else 512 * 1024 * 1024
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    workdir = tempfile.mkdtemp(prefix='bench_sendfile_')
+    try:
+        os.mkdir(os.path.join(workdir, 'www'))
+        with open(os.path.join(workdir, 'www', FILE_NAME), 'wb') as f:
+            block = os.urandom(1 << 20)
+            for _ in range(size // len(block)):
+                f.write(block)
+            f.write(block[:size % len(block)])
+        print(f'{server}: {size / (1 << 20):.0f} MiB file fetched {repeat} times')
+        for sendfile in (False, True):
+            run(workdir, server, sendfile, size, repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+The per-character extract_python_tags() that PyServe shipped before the
+find/regex scanner, kept verbatim as the reference for tests/test_tokenizer.py
+and bench/bench_scanner.py.
+"""
+
+
+def extract_python_tags(html_content):
+    """
+    从HTML中提取内容，返回 [("html", ...), ("python", ...), ...] 格式的列表
+    """
+    def _find_tag_end(html_content, start):
+        i = start
+        length = len(html_content)
+        while i < length:
+            c = html_content[i]
+            if c == '>':
+                return i
+            elif c in ('"', "'"):
+                quote = c
+                i += 1
+                while i < length:
+                    ch = html_content[i]
+                    if ch == quote:
+                        break
+                    i += 1
+            i += 1
+        return -1
+    def _find_raw_text_end(html_content, i, end_tag):
+        length = len(html_content)
+        end_tag_len = len(end_tag)
+        in_string = False
+        string_char = None
+        while i < length:
+            c = html_content[i]
+            if in_string:
+                if c == '\\':
+                    i += 2
+                    continue
+                if c == string_char:
+                    in_string = False
+            else:
+                if html_content[i:i + end_tag_len].lower() == end_tag:
+                    return i
+                if c in ('"', "'", '`'):
+                    in_string = True
+                    string_char = c
+            i += 1
+        return -1
+    results = []
+    i = 0
+    length = len(html_content)
+    in_comment = False
+    in_script = False
+    in_style = False
+    in_cdata = False
+    in_python_tag = False
+    python_start = -1
+    python_depth = 0
+    html_start = 0
+    def flush_html(end):
+        """将 [html_start, end) 范围内的 HTML 内容追加到结果"""
+        nonlocal html_start
+        chunk = html_content[html_start:end]
+        if chunk:
+            results.append(("html", chunk))
+        html_start = end
+    while i < length:
+        if in_cdata:
+            if html_content[i:i + 3] == ']]>':
+                in_cdata = False
+                i += 3
+            else:
+                i += 1
+            continue
+        if html_content[i:i + 9] == '<![CDATA[':
+            in_cdata = True
+            i += 9
+            continue
+        if in_script:
+            end_pos = _find_raw_text_end(html_content, i, '</script>')
+            if end_pos == -1:
+                break
+            in_script = False
+            i = end_pos + 9
+            continue
+        if in_style:
+            end_pos = _find_raw_text_end(html_content, i, '</style>')
+            if end_pos == -1:
+                break
+            in_style = False
+            i = end_pos + 8
+            continue
+        if not in_comment and html_content[i:i + 4] == '<!--':
+            in_comment = True
+            i += 4
+            continue
+        if in_comment and html_content[i:i + 3] == '-->':
+            in_comment = False
+            i += 3
+            continue
+        if in_comment:
+            i += 1
+            continue
+        if not in_script and not in_python_tag and i + 7 <= length:
+            tag_check = html_content[i:i + 7].lower()
+            if tag_check == '<script' and (
+                i + 7 >= length or html_content[i + 7] in ' \t\n\r>/'):
+                close = _find_tag_end(html_content, i + 7)
+                if close != -1:
+                    in_script = True
+                    i = close + 1
+                else:
+                    i += 1
+                continue
+        if not in_style and not in_python_tag and i + 6 <= length:
+            tag_check = html_content[i:i + 6].lower()
+            if tag_check == '<style' and (
+                i + 6 >= length or html_content[i + 6] in ' \t\n\r>/'):
+                close = _find_tag_end(html_content, i + 6)
+                if close != -1:
+                    in_style = True
+                    i = close + 1
+                else:
+                    i += 1
+                continue
+        if i + 8 <= length and html_content[i:i + 8].lower() == '<python>':
+            if not in_python_tag:
+                flush_html(i)
+                html_start = i + 8
+                in_python_tag = True
+                python_start = i + 8
+                python_depth = 1
+            else:
+                python_depth += 1
+            i += 8
+            continue
+        if in_python_tag and i + 9 <= length:
+            if html_content[i:i + 9].lower() == '</python>':
+                python_depth -= 1
+                if python_depth == 0:
+                    content = html_content[python_start:i]
+                    results.append(("python", content))
+                    in_python_tag = False
+                    python_start = -1
+                    html_start = i + 9
+                i += 9
+                continue
+        i += 1
+    if in_python_tag:
+        results.append(("python", f'echo("<span class="python-warning">Unclosed <python> tag detected (depth={python_depth}), content discarded.</span>")'))
+    else:
+        flush_html(length)
+    return results
@@ -0,0 +1,141 @@
+"""
+Differential tests for the <python> tag scanners.
+
+extract_python_tags() of both servers is compared with the per-character
+scanner it replaced (legacy_scanner.py), and PPTokenizer, fed the same
+document in random chunks, with extract_python_tags() on the whole text.
+
+Run from the repository root:  python -m pytest -q tests
+"""
+import importlib
+import os
+import random
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, TESTS_DIR)
+
+from legacy_scanner import extract_python_tags as legacy_extract_python_tags
+
+# Fragments random documents are built from: every construct the scanner
+# tracks, in several spellings, plus quotes, escapes and non-ASCII text
+FRAGMENTS = [
+    '<python>', '</python>', '<PYTHON>', '</Python>', '<python', '</python',
+    '<!--', '-->', '<![CDATA[', ']]>',
+    '<script>', '<script type="x">', "<script src='>'>", '<script', '</script>', '</SCRIPT>', '<scripts>',
+    '<style>', '</style>', "<style a='>'>", '<STYLE>', '</style',
+    '"', "'", '`', '\\', '>', '<', '/', '-', '!', '[', ']',
+    'a', 'b c', '\n', '\t', 'é', '中文', 'x = 1\n', 'echo(1)\n',
+]
+
+CORPUS = [
+    '',
+    'plain text only',
+    '<python>echo(1)</python>',
+    'a<python>x = 1</python>b<python>echo(x)</python>c',
+    '<PyThOn>echo(1)</PYTHON>',
+    '<python>outer<python>inner</python>tail</python>after',
+    '<python>never closed',
+    '<python><python>depth two</python>',
+    '<!-- <python>commented</python> -->shown',
+    '<!-- unterminated <python>x</python>',
+    '<![CDATA[<python>x</python>]]><python>y</python>',
+    '<script>var s = "</script>"; <python>x</python></script><python>y</python>',
+    "<script>var s = '\\'</script>'</script>tail",
+    '<script type="text/javascript">`<python>`</script>',
+    '<script src="a>b"></script><python>z</python>',
+    '<style>p::after { content: "</style>" }</style><python>s</python>',
+    '<scripts><python>not raw text</python></scripts>',
+    '<script',
+    '<style',
+    '<python>é 中文</python>é',
+]
+
+
+def load(name):
+    # The servers read their config directory from the command line when imported
+    argv = sys.argv
+    sys.argv = [argv[0], os.path.join(ROOT, 'config')]
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.argv = argv
+
+
+@pytest.fixture(scope='module', params=['PyServe', 'DinoWebServe'])
+def server(request):
+    return load(request.param)
+
+
+def random_documents(seed, count, max_fragments=30):
+    rnd = random.Random(seed)
+    for _ in range(count):
+        yield ''.join(rnd.choice(FRAGMENTS) for _ in range(rnd.randint(0, max_fragments)))
+
+
+def merge_html(segments):
+    """Normalise segments for comparison: static text as bytes, adjacent spans joined"""
+    merged = []
+    for kind, value in segments:
+        if kind == 'html' and isinstance(value, str):
+            value = value.encode('utf-8')
+        if kind == 'html' and merged and merged[-1][0] == 'html':
+            merged[-1] = ('html', merged[-1][1] + value)
+        else:
+            merged.append((kind, value))
+    return merged
+
+
+def tokenize_in_chunks(server, data, rnd):
+    tokenizer = server.PPTokenizer()
+    segments = []
+    pos = 0
+    while pos < len(data):
+        step = rnd.choice([1, 1, 2, 3, 5, 8, 13, 100])
+        segments += tokenizer.feed(data[pos:pos + step])
+        pos += step
+    segments += tokenizer.close()
+    return segments
+
+
+@pytest.mark.parametrize('document', CORPUS)
+def test_corpus_matches_legacy_scanner(server, document):
+    assert server.extract_python_tags(document) == legacy_extract_python_tags(document)
+
+
+def test_random_documents_match_legacy_scanner(server):
+    for document in random_documents(seed=4, count=20000):
+        assert server.extract_python_tags(document) == legacy_extract_python_tags(document), document
+
+
+def test_large_static_page_matches_legacy_scanner(server):
+    document = ''.join(random_documents(seed=5, count=400, max_fragments=60))
+    assert server.extract_python_tags(document) == legacy_extract_python_tags(document)
+
+
+@pytest.mark.parametrize('document', CORPUS)
+def test_pp_tokenizer_corpus(server, document):
+    rnd = random.Random(document)
+    expected = merge_html(server.extract_python_tags(document))
+    assert merge_html(tokenize_in_chunks(server, document.encode('utf-8'), rnd)) == expected
+
+
+def test_pp_tokenizer_random_chunks(server):
+    rnd = random.Random(18)
+    for document in random_documents(seed=18, count=20000):
+        expected = merge_html(server.extract_python_tags(document))
+        assert merge_html(tokenize_in_chunks(server, document.encode('utf-8'), rnd)) == expected, document
+
+
+def test_pp_tokenizer_streams_static_text(server):
+    # Static text comes out before close(); only a tail that could still start a tag is held back
+    tokenizer = server.PPTokenizer()
+    static = b'<p>static</p>\n' * 100
+    released = b''.join(value for _, value in tokenizer.feed(static))
+    assert static.startswith(released) and len(static) - len(released) < len('<![CDATA[')
+    segments = tokenizer.feed(b'<python>echo(1)</python>') + tokenizer.close()
+    assert merge_html([('html', released)] + segments) == [('html', static), ('python', 'echo(1)')]